@@ -32,5 +32,64 @@ def add_source_place_id(db_file_path: str):
     con.close()
 
 
+@cli.command()
+@click.argument('db_file_path')
+def add_render_cache_hash_fields(db_file_path: str):
+    con = sqlite3.connect(db_file_path)
+    with con:
+        con.execute("ALTER TABLE render_cache ADD content_hash VARCHAR")
+        con.execute("ALTER TABLE render_cache ADD build_timestamp DATETIME")
+    con.close()
+
+
+@cli.command()
+@click.argument('db_file_path')
+def add_render_cache_compressed_fields(db_file_path: str):
+    con = sqlite3.connect(db_file_path)
+    with con:
+        con.execute("ALTER TABLE render_cache ADD value_gzip BLOB")
+        con.execute("ALTER TABLE render_cache ADD value_br BLOB")
+    con.close()
+
+
+@cli.command()
+@click.argument('db_file_path')
+def drop_render_cache_for_generations(db_file_path: str):
+    """Drops the render cache tables so they are created with the generation columns. Run
+    `flask batchtool render-cache` after starting the app to rebuild the cache."""
+    con = sqlite3.connect(db_file_path)
+    with con:
+        con.execute("DROP TABLE IF EXISTS render_cache")
+        con.execute("DROP TABLE IF EXISTS render_cache_generation")
+    con.close()
+
+
+@cli.command()
+@click.argument('db_file_path')
+def add_club_status_date_parsed(db_file_path: str):
+    """Adds the indexed date copy of club status_date, set from the existing values."""
+    con = sqlite3.connect(db_file_path)
+    with con:
+        con.execute("ALTER TABLE club ADD status_date_parsed DATE")
+        con.execute("CREATE INDEX ix_club_status_date_parsed ON club (status_date_parsed)")
+        con.execute("UPDATE club SET status_date_parsed = status_date "
+                    "WHERE status_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' "
+                    "AND date(status_date, '+0 days') = status_date")
+    con.close()
+
+
+@cli.command()
+@click.argument('db_file_path')
+def add_place_comment_indexes(db_file_path: str):
+    con = sqlite3.connect(db_file_path)
+    with con:
+        con.execute("CREATE INDEX ix_place_comment_timestamp_id ON place_comment (timestamp, id)")
+        con.execute("CREATE INDEX ix_place_comment_spam_status_timestamp_id ON place_comment "
+                    "(akismet_spam_status, timestamp, id)")
+        con.execute("CREATE INDEX ix_place_comment_place_id_timestamp_id ON place_comment "
+                    "(place_id, timestamp, id)")
+    con.close()
+
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
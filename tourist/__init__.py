@@ -4,6 +4,7 @@ import re
 from logging.handlers import RotatingFileHandler
 import logging
 import os.path
+from typing import AbstractSet
 from typing import Optional
 
 import attrs
@@ -18,6 +19,7 @@ from werkzeug.middleware.profiler import ProfilerMiddleware
 
 import tourist.models.tstore
 from tourist import render_factory
+from tourist import render_store
 from tourist.models import tstore
 from sqlalchemy import event
 import tourist.config
@@ -147,22 +149,90 @@ def create_app(config_object: Optional[tourist.config.BaseConfig] = None):
             if isinstance(instance, tstore.Entity):
                 instance.validate()
 
+    @event.listens_for(db.session, "after_flush")
+    def after_flush(session, flush_context):
+        # Remember which entities changed so that `update_render_cache` only rebuilds the rows
+        # built from them. Ids of new instances are set by the time after_flush is called.
+        # A parent is in session.dirty when only a collection, such as Place.comments, changed.
+        # The dependencies of the child already include the pages of its old and new parent.
+        modified = {instance for instance in session.dirty
+                    if session.is_modified(instance, include_collections=False)}
+        for instance in session.new | modified | session.deleted:
+            if isinstance(instance, (tstore.Entity, tstore.EntityChild)):
+                session.info.setdefault(UPDATE_RENDER_AFTER_FLUSH, set()).add(
+                    render_factory.entity_key(instance))
+
     return app
 
 
 def update_render_cache(session):
-    new_cache_ids = []
+    """Update the RenderCache after entities were committed in `session`. When RENDER_CACHE_BACKGROUND
+    is set this only adds a marker for the worker started by `flask batchtool render-cache --worker`."""
+    changed_entity_keys = session.info.pop(UPDATE_RENDER_AFTER_FLUSH, None)
+    if current_app.config.get('RENDER_CACHE_BACKGROUND'):
+        session.add(tstore.RenderCacheDirty(
+            entity_keys=None if changed_entity_keys is None else sorted(changed_entity_keys)))
+        session.commit()
+        return
+    # Old generations are removed by `flask batchtool render-cache-gc` or the worker, not while
+    # the edit request holds the write lock.
+    rebuild_render_cache(session, changed_entity_keys)
+
+
+def rebuild_render_cache(session, changed_entity_keys: Optional[AbstractSet[str]],
+                         profile: Optional[render_factory.BuildProfile] = None,
+                         processes: int = 1) -> Optional[render_store.WriteResult]:
+    """Rebuild the RenderCache rows that depend on the entities in `changed_entity_keys` in a new
+    RenderCacheGeneration. Every row is rebuilt if `changed_entity_keys` is None. The time spent
+    in each stage is added to `profile` and logged. Place pages are built in `processes`
+    processes. Returns what was written or None if the build failed."""
+    if profile is None:
+        profile = render_factory.BuildProfile()
     try:
-        new_cache = list(render_factory.yield_cache())
+        if changed_entity_keys is None:
+            affected_names = None
+        else:
+            with profile.stage('affected names') as stats:
+                affected_names = render_factory.get_affected_names(changed_entity_keys)
+                stats.count = len(changed_entity_keys)
+        new_cache = list(render_factory.yield_cache(affected_names, profile, processes))
     except (ValueError, AttributeError):
         current_app.logger.exception("Exception in render factory. Update of rendered site DISABLED.")
+        # Changes since the last successful build are lost. Drop the dependencies so that the
+        # next update rebuilds every row.
+        session.rollback()
+        render_store.get_store().delete_name(render_factory.RenderName.DEPENDENCIES.value)
         return
-    for new_cache_item in new_cache:
-        session.add(new_cache_item)
-        new_cache_ids.append(new_cache_item.name)
-    # Remove rows in RenderCache not in new_cache_ids. This should be removed places.
-    session.query(tstore.RenderCache).filter(tstore.RenderCache.name.notin_(new_cache_ids)).delete()
+    with profile.stage('write') as stats:
+        result = render_store.get_store().write_generation(new_cache, affected_names)
+        stats.count = result.written_count
+    current_app.logger.info(f"Rebuilt render cache, wrote {result.written_count} rows and skipped "
+                            f"{result.skipped_count} unchanged rows\n{profile.format_table()}")
+    return result
+
+
+def process_render_cache_updates(session) -> bool:
+    """Rebuild the RenderCache once for all RenderCacheDirty markers. Returns False if there were
+    no markers."""
+    markers = session.query(tstore.RenderCacheDirty).order_by(tstore.RenderCacheDirty.id).all()
+    if not markers:
+        # End the read transaction so that the next call sees new markers.
+        session.rollback()
+        return False
+    changed_entity_keys = set()
+    for marker in markers:
+        if marker.entity_keys is None:
+            changed_entity_keys = None
+            break
+        changed_entity_keys.update(marker.entity_keys)
+    last_marker_id = markers[-1].id
+    current_app.logger.info(f"Rebuilding render cache for {len(markers)} updates")
+    rebuild_render_cache(session, changed_entity_keys)
+    # Markers added while rebuilding have a larger id and are handled by the next call.
+    session.query(tstore.RenderCacheDirty).filter(
+        tstore.RenderCacheDirty.id <= last_marker_id).delete()
     session.commit()
+    return True
 
 
 def initialise_logger(app):
@@ -16,6 +16,22 @@ class BaseConfig:
     DEFAULT_CENTER_LONG = 1  # Must be non-zero to get included
     LEAFLET_CONTROL_GEOCODER = 1  # Enables geocoder control in flask-admin interface
     DATA_DIR: pathlib.Path
+    # When True edits only add a RenderCacheDirty marker and the RenderCache is rebuilt by
+    # `flask batchtool render-cache --worker`.
+    RENDER_CACHE_BACKGROUND = False
+    # Path of a SQLite file for the RenderCache. When None the RenderCache table in tourist.db is
+    # used.
+    RENDER_CACHE_SQLITE_PATH = None
+    # Seconds the short_name index used to redirect old URLs is used without checking for a new
+    # RenderCacheGeneration.
+    RENDER_CACHE_SHORT_NAMES_MAX_AGE = 5
+    # Pages rendered for anonymous visitors kept by each process until the RenderCacheGeneration
+    # changes. This is more than the few thousand place pages so that every page of the site fits.
+    # Memory use is about this many times the size of the HTML of a place page.
+    ANONYMOUS_HTML_CACHE_SIZE = 5000
+    # Seconds that HTML rendered for anonymous visitors, and its ETag, is used before it is rendered
+    # again to update humanized times such as "5 minutes ago".
+    ANONYMOUS_HTML_CACHE_SECONDS = 10 * 60
 
     @property
     def SQLITE_DB_PATH(self) -> str:
@@ -73,6 +89,7 @@ def make_test_config(tmp_path: pathlib.Path) -> BaseConfig:
         DATA_DIR = tmp_path
         TESTING = True
         ALLOW_UNAUTHENTICATED_ADMIN = False
+        RENDER_CACHE_SHORT_NAMES_MAX_AGE = 0
     return TestConfig()
 
 
@@ -1,14 +1,16 @@
+import threading
 from collections import defaultdict
 from typing import Any
+from typing import Collection
 from typing import Dict
 from typing import List
-from typing import Set
+from typing import Optional
+from typing import Tuple
 from typing import Type
 
 import attrs
 import sqlalchemy
 import sqlalchemy_continuum
-from more_itertools import last
 
 from tourist.models import tstore
 
@@ -26,73 +28,217 @@ type_to_version_cls = {
 
 
 
+@attrs.frozen()
+class EntityVersion:
+    """One row of a version table. `values` are in the order of `VersionTable.column_keys`."""
+    transaction_id: int
+    values: Tuple
+
+
 @attrs.frozen()
 class VersionTable:
-    """In-memory copy of one Version table, built up while replaying transactions
+    """In-memory copy of one Version table, with the versions of each entity in transaction order.
     """
-    entity_types: Set[str]
     version_cls: Type
-    versions: Dict[int, List] = attrs.field(factory=lambda: defaultdict(list))
-
-    def add_version_object(self, transaction: Transaction, new_version_obj):
-        prev_version = last(self.versions[new_version_obj.id], None)
-        if prev_version:
-            assert prev_version.end_transaction_id == transaction.id
-        self.versions[new_version_obj.id].append(new_version_obj)
-
+    # Columns of `version_cls` that are not internal to continuum.
+    column_keys: Tuple[str, ...]
+    versions: Dict[int, List[EntityVersion]] = attrs.field(factory=lambda: defaultdict(list))
+    # Changesets by (entity id, index) so each is only computed once
+    changesets: Dict[Tuple[int, int], Dict[str, List]] = attrs.field(factory=dict)
 
-@attrs.frozen()
+    @staticmethod
+    def make(version_cls: Type) -> 'VersionTable':
+        column_keys = tuple(
+            key for key in sqlalchemy.inspect(version_cls).columns.keys()
+            if not sqlalchemy_continuum.utils.is_internal_column(version_cls, key))
+        return VersionTable(version_cls=version_cls, column_keys=column_keys)
+
+    def load(self, after_transaction_id: int, last_transaction_id: int):
+        """Appends versions created by transactions after `after_transaction_id` up to and
+        including `last_transaction_id` with one query."""
+        columns = [getattr(self.version_cls, key) for key in self.column_keys]
+        rows = tstore.db.session.execute(
+            sqlalchemy.select(self.version_cls.transaction_id, *columns).where(
+                self.version_cls.transaction_id > after_transaction_id,
+                self.version_cls.transaction_id <= last_transaction_id).order_by(
+                self.version_cls.transaction_id))
+        id_index = self.column_keys.index('id')
+        for transaction_id, *values in rows:
+            self.versions[values[id_index]].append(EntityVersion(transaction_id, tuple(values)))
+
+    def clear(self):
+        self.versions.clear()
+        self.changesets.clear()
+
+    def load_changes(self, *where) -> List[Tuple[EntityVersion, Dict[str, List]]]:
+        """Returns the versions matching the `where` clauses, newest first, with their changeset,
+        without using the in-memory `versions`. Only those versions and the versions they replaced
+        are read, using the indexed transaction_id and end_transaction_id columns."""
+        columns = [getattr(self.version_cls, key) for key in self.column_keys]
+        id_index = self.column_keys.index('id')
+        versions = [EntityVersion(transaction_id, tuple(values))
+                    for transaction_id, *values in tstore.db.session.execute(
+                        sqlalchemy.select(self.version_cls.transaction_id, *columns).where(
+                            *where).order_by(self.version_cls.transaction_id.desc(),
+                                             self.version_cls.id))]
+        if not versions:
+            return []
+        previous = {}
+        for end_transaction_id, *values in tstore.db.session.execute(
+                sqlalchemy.select(self.version_cls.end_transaction_id, *columns).where(
+                    self.version_cls.end_transaction_id.in_({v.transaction_id for v in versions}),
+                    self.version_cls.id.in_({v.values[id_index] for v in versions}))):
+            previous[(end_transaction_id, values[id_index])] = EntityVersion(
+                end_transaction_id, tuple(values))
+        return [(v, self.changeset(v, previous.get((v.transaction_id, v.values[id_index]))))
+                for v in versions]
+
+    def load_transaction_changes(self, transaction_ids: Collection[int]) -> \
+            Dict[int, List[Tuple[EntityVersion, Dict[str, List]]]]:
+        """Returns the versions made by each of `transaction_ids`, with their changeset."""
+        changes = defaultdict(list)
+        for version, changeset in self.load_changes(
+                self.version_cls.transaction_id.in_(transaction_ids)):
+            changes[version.transaction_id].append((version, changeset))
+        return changes
+
+    def load_entity_transaction_ids(self, entity_ids: Collection[int], before: Optional[int],
+                                    limit: int) -> List[int]:
+        """Returns the transaction ids of the newest `limit` versions of `entity_ids` made by
+        transactions before `before`, newest first."""
+        query = sqlalchemy.select(self.version_cls.transaction_id).where(
+            self.version_cls.id.in_(entity_ids)).order_by(
+            self.version_cls.transaction_id.desc()).limit(limit)
+        if before is not None:
+            query = query.where(self.version_cls.transaction_id < before)
+        return list(tstore.db.session.execute(query).scalars())
+
+    def get_value(self, version: EntityVersion, key: str) -> Any:
+        return version.values[self.column_keys.index(key)]
+
+    def get_changeset(self, entity_id: int, index: int) -> Dict[str, List]:
+        """Returns the changeset of version `index` of entity `entity_id` from the version before
+        it, computed the first time it is used."""
+        key = (entity_id, index)
+        changeset = self.changesets.get(key)
+        if changeset is None:
+            history = self.versions[entity_id]
+            changeset = self.changeset(history[index], history[index - 1] if index > 0 else None)
+            self.changesets[key] = changeset
+        return changeset
+
+    def changeset(self, current_version: EntityVersion,
+                  previous_version: Optional[EntityVersion]) -> Dict[str, List]:
+        """
+        Return a dictionary of changed fields in this version with keys as
+        field names and values as lists with first value as the old field value
+        and second list value as the new value.
+
+        This is a very ugly copy of sqlalchemy_continuum.version.VersionClassBase which I created
+        because accessing the previous version is super slow.
+        """
+        data = {}
+        for i, key in enumerate(self.column_keys):
+            if not previous_version:
+                old = None
+            else:
+                old = previous_version.values[i]
+            new = current_version.values[i]
+            if old != new:
+                data[key] = [old, new]
+        return data
+
+
+@attrs.define()
 class VersionTables:
     """In memory dump of continuum versions and transactions, created to make iterating through
     them run about 60 times faster. There is similar code in `batchtool`.
 
-    TODO(TomGoBravo): add some tests for this
+    `populate` only reads transactions added since it was last called so keep an instance, as
+    `get_version_tables` does, instead of making a new one for each use.
     """
     version_tables: Dict[Type, VersionTable]
     transaction_user_email: Dict[int, str] = attrs.field(factory=dict)
     transaction_issued_at: Dict[int, Any] = attrs.field(factory=dict)
+    max_transaction_id: int = 0
+    transaction_count: int = 0
 
     @staticmethod
-    def make() -> 'VersionSyncer':
-        version_tables = {version_cls: VersionTable(entity_types={type_str}, version_cls=version_cls)
-                          for type_str, version_cls in type_to_version_cls.items()}
+    def make() -> 'VersionTables':
+        version_tables = {version_cls: VersionTable.make(version_cls)
+                          for version_cls in type_to_version_cls.values()}
         return VersionTables(version_tables=version_tables)
 
     def populate(self):
-        existing_transactions = Transaction.query.all()
-        for transaction in existing_transactions:
-            if transaction.user:
-                self.transaction_user_email[transaction.id] = transaction.user.email
-            self.transaction_issued_at[transaction.id] = transaction.issued_at
-            for version_cls, cls_changed_entities in transaction.changed_entities.items():
-                for version_obj in cls_changed_entities:
-                    self.version_tables[version_cls].add_version_object(transaction, version_obj)
-
-    def get_object_history(self, obj):
-        obj_version_type = sqlalchemy_continuum.version_class(obj.__class__)
-        version_table = self.version_tables[obj_version_type]
-        return version_table.versions[obj.id]
-
-
-def changeset(current_version, previous_version):
-    """
-    Return a dictionary of changed fields in this version with keys as
-    field names and values as lists with first value as the old field value
-    and second list value as the new value.
-
-    This is a very ugly copy of sqlalchemy_continuum.version.VersionClassBase which I created
-    because accessing the previous version is super slow.
-    """
-    data = {}
-
-    for key in sqlalchemy.inspect(current_version.__class__).columns.keys():
-        if sqlalchemy_continuum.utils.is_internal_column(current_version, key):
-            continue
-        if not previous_version:
-            old = None
-        else:
-            old = getattr(previous_version, key)
-        new = getattr(current_version, key)
-        if old != new:
-            data[key] = [old, new]
-    return data
+        """Loads transactions with an id larger than any already loaded and their versions, with
+        one query per table. Everything is loaded again if the transactions that were already
+        loaded changed, such as after `batchtool transactionshift`."""
+        loaded_count = tstore.db.session.query(sqlalchemy.func.count(Transaction.id)).filter(
+            Transaction.id <= self.max_transaction_id).scalar()
+        if loaded_count != self.transaction_count:
+            for version_table in self.version_tables.values():
+                version_table.clear()
+            self.transaction_user_email.clear()
+            self.transaction_issued_at.clear()
+            self.max_transaction_id = 0
+            self.transaction_count = 0
+
+        new_transactions = tstore.db.session.execute(
+            sqlalchemy.select(Transaction.id, Transaction.issued_at, tstore.User.email).outerjoin(
+                Transaction.user).where(Transaction.id > self.max_transaction_id).order_by(
+                Transaction.id)).all()
+        if not new_transactions:
+            return
+        for transaction_id, issued_at, user_email in new_transactions:
+            if user_email is not None:
+                self.transaction_user_email[transaction_id] = user_email
+            self.transaction_issued_at[transaction_id] = issued_at
+        # Versions of transactions committed after the select above are left for the next call,
+        # when their transaction is read too, so they aren't loaded twice.
+        last_transaction_id = new_transactions[-1][0]
+        for version_table in self.version_tables.values():
+            version_table.load(self.max_transaction_id, last_transaction_id)
+        self.max_transaction_id = last_transaction_id
+        self.transaction_count += len(new_transactions)
+
+    def get_version_table(self, obj) -> VersionTable:
+        return self.version_tables[sqlalchemy_continuum.version_class(obj.__class__)]
+
+    def get_object_history(self, obj) -> List[EntityVersion]:
+        return self.get_version_table(obj).versions[obj.id]
+
+
+def load_transactions(before: Optional[int], limit: int) -> List[Tuple[int, Any, Optional[str]]]:
+    """Returns (id, issued_at, user email) of up to `limit` transactions with an id less than
+    `before`, or of the latest transactions if `before` is None, newest first."""
+    query = sqlalchemy.select(Transaction.id, Transaction.issued_at, tstore.User.email).outerjoin(
+        Transaction.user).order_by(Transaction.id.desc()).limit(limit)
+    if before is not None:
+        query = query.where(Transaction.id < before)
+    return [tuple(row) for row in tstore.db.session.execute(query)]
+
+
+def load_transactions_by_id(transaction_ids: Collection[int]) -> \
+        Dict[int, Tuple[Any, Optional[str]]]:
+    """Returns (issued_at, user email) of each of `transaction_ids`, with one query."""
+    query = sqlalchemy.select(Transaction.id, Transaction.issued_at, tstore.User.email).outerjoin(
+        Transaction.user).where(Transaction.id.in_(transaction_ids))
+    return {transaction_id: (issued_at, user_email)
+            for transaction_id, issued_at, user_email in tstore.db.session.execute(query)}
+
+
+_version_tables_by_url: Dict[str, VersionTables] = {}
+_version_tables_lock = threading.Lock()
+
+
+def get_version_tables() -> VersionTables:
+    """Returns the VersionTables of the current database, kept between calls so that only new
+    transactions are read."""
+    url = str(tstore.db.engine.url)
+    with _version_tables_lock:
+        version_tables = _version_tables_by_url.get(url)
+        if version_tables is None:
+            version_tables = VersionTables.make()
+            _version_tables_by_url[url] = version_tables
+        version_tables.populate()
+    return version_tables
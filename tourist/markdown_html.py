@@ -0,0 +1,76 @@
+"""Conversion of entity markdown to sanitized HTML, done while building the RenderCache so that
+pages are served without converting markdown or querying the pools of [[WikiLinks]].
+"""
+import re
+import urllib.parse
+from typing import Callable
+from typing import Optional
+
+import bs4
+import markdown
+
+from tourist.wikilinks import WikiLinkExtension
+
+
+# Tags kept in the HTML. Other tags are removed, keeping their content.
+ALLOWED_TAGS = frozenset([
+    'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'del', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'hr', 'i', 'img', 'li', 'ol', 'p', 'pre', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'th',
+    'thead', 'tr', 'ul',
+])
+# Tags removed with their content.
+REMOVED_TAGS = frozenset(['script', 'style', 'iframe', 'object', 'embed', 'template'])
+ALLOWED_ATTRIBUTES = {
+    'a': frozenset(['href', 'title']),
+    'abbr': frozenset(['title']),
+    'img': frozenset(['src', 'alt', 'title', 'width', 'height']),
+    'td': frozenset(['align']),
+    'th': frozenset(['align']),
+}
+URL_ATTRIBUTES = frozenset(['href', 'src'])
+# URLs without a scheme, such as '#poolname', are also allowed.
+ALLOWED_URL_SCHEMES = frozenset(['http', 'https', 'mailto', 'tel'])
+
+
+def _is_allowed_url(url: str) -> bool:
+    # Browsers ignore whitespace and control characters in a scheme, as in 'java\tscript:'.
+    scheme = urllib.parse.urlsplit(re.sub(r'[\x00-\x20]', '', url)).scheme
+    return scheme == '' or scheme.lower() in ALLOWED_URL_SCHEMES
+
+
+def sanitize_html(html: str) -> str:
+    """Returns `html` with only ALLOWED_TAGS, their ALLOWED_ATTRIBUTES and URLs with an allowed
+    scheme."""
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    for node in soup.find_all(string=lambda s: isinstance(s, bs4.element.PreformattedString)):
+        # Comments, CDATA, doctypes and processing instructions
+        node.extract()
+    for tag in soup.find_all(True):
+        if tag.decomposed:
+            # Inside a tag that was removed
+            continue
+        if tag.name in REMOVED_TAGS:
+            tag.decompose()
+        elif tag.name not in ALLOWED_TAGS:
+            tag.unwrap()
+        else:
+            allowed_attributes = ALLOWED_ATTRIBUTES.get(tag.name, frozenset())
+            for name, value in list(tag.attrs.items()):
+                if name not in allowed_attributes or (
+                        name in URL_ATTRIBUTES and not _is_allowed_url(value)):
+                    del tag[name]
+    return str(soup)
+
+
+class MarkdownToHtml:
+    """Converts markdown to sanitized HTML with the extensions of the `markdown` template filter.
+    [[WikiLinks]] to a pool are resolved with `get_pool_name` instead of a database query."""
+    def __init__(self, get_pool_name: Callable[[str], Optional[str]]):
+        self._markdown = markdown.Markdown(
+            extensions=[WikiLinkExtension(get_pool_name=get_pool_name)])
+
+    def convert(self, text: Optional[str]) -> str:
+        if not text:
+            return ''
+        self._markdown.reset()
+        return sanitize_html(self._markdown.convert(text))
@@ -38,6 +38,8 @@ class Club:
     status_date: Optional[str]
     logo_url: Optional[str] = None
     source: Optional[ClubSource] = None
+    # markdown converted to sanitized HTML. None in rows built before it was added.
+    markdown_html: Optional[str] = None
 
     @property
     def club_state(self) -> ClubState:
@@ -65,6 +67,8 @@ class Pool:
     markdown: str
     club_back_links: List[ClubShortNameName]
     maps_point_query: str
+    # markdown converted to sanitized HTML. None in rows built before it was added.
+    markdown_html: Optional[str] = None
 
 
 @attrs.frozen()
@@ -74,6 +78,8 @@ class PlaceComment:
     source: str
     content: Optional[str] = None
     content_markdown: Optional[str] = None
+    # content_markdown converted to sanitized HTML. None in rows built before it was added.
+    content_html: Optional[str] = None
 
 
 @attrs.frozen()
@@ -101,22 +107,6 @@ class RecentlyUpdated:
     source_name: Optional[str] = None
 
 
-@attrs.frozen()
-class PlaceEntityChanges:
-    """Changes for an entity (place, club, pool) in a very crude format, but good enough for
-    debugging."""
-
-    @attrs.frozen()
-    class Change:
-        """A single version of an entity"""
-        timestamp: datetime.datetime
-        user: str
-        change: str
-
-    entity_name: str
-    changes: List[Change] = attrs.field(factory=list)
-
-
 @attrs.frozen()
 class Place:
     id: int
@@ -132,8 +122,74 @@ class Place:
     comments: List[PlaceComment] = attrs.field(factory=list)
     # recently_updated, only set for 'world'
     recently_updated: Optional[List[RecentlyUpdated]] = None
-    # changes for this place and all direct children. not set for 'world'
-    changes: Optional[List[PlaceEntityChanges]] = None
+    # markdown converted to sanitized HTML. None in rows built before it was added.
+    markdown_html: Optional[str] = None
+
+
+@attrs.frozen()
+class PlaceHistory:
+    """Changes to a place and its direct children (place, club, pool) in a very crude format, but
+    good enough for debugging. Newest first, one page at a time."""
+
+    @attrs.frozen()
+    class Change:
+        """A single version of an entity"""
+        transaction_id: int
+        timestamp: datetime.datetime
+        user: Optional[str]
+        entity_name: str
+        change: str
+
+    place: ChildPlace
+    changes: List[Change] = attrs.field(factory=list)
+    # Pass as `before` to get the next page of older changes. None when there are no more.
+    next_before: Optional[int] = None
+
+
+@attrs.frozen()
+class TransactionLog:
+    """A page of transactions, newest first, with the changes each made to places, clubs and
+    pools in the same crude format as PlaceHistory."""
+
+    @attrs.frozen()
+    class EntityChange:
+        entity_name: str
+        change: str
+
+    @attrs.frozen()
+    class Transaction:
+        transaction_id: int
+        issued_at: Optional[datetime.datetime]
+        user: Optional[str]
+        places: List['TransactionLog.EntityChange']
+        clubs: List['TransactionLog.EntityChange']
+        pools: List['TransactionLog.EntityChange']
+
+    transactions: List[Transaction]
+    # Pass as `before` to get the next page of older transactions. None when there are no more.
+    next_before: Optional[int] = None
+
+
+@attrs.frozen()
+class ShortNames:
+    """The pages of every place, club and pool, by short_name. Used to redirect old URLs."""
+
+    @attrs.frozen()
+    class Target:
+        # 'pool', 'club' or 'place'
+        type: str
+        path: str
+
+    # A club, place and pool may have the same short_name. Targets are in the order pool, club,
+    # place, the order they were searched in before this index.
+    targets: Dict[str, List[Target]] = attrs.field(factory=dict)
+
+    def get(self, short_name: str, type: Optional[str] = None) -> Optional[Target]:
+        """Returns the first target of `short_name`, of `type` if it is set, or None."""
+        for target in self.targets.get(short_name, ()):
+            if type is None or target.type == type:
+                return target
+        return None
 
 
 @attrs.frozen()
@@ -3,13 +3,17 @@ Objects that store hockey tourist data for editing.
 """
 
 import datetime
+import functools
 import math
 import re
 from abc import abstractmethod
+from collections import defaultdict
 from itertools import chain
 from typing import Dict, Union, Optional
+from typing import FrozenSet
 from typing import Iterable
 from typing import List
+from typing import Tuple
 
 import geojson
 import attr
@@ -62,12 +66,36 @@ def optional_geometry_to_shape(geom: Optional[Union[str, WKTElement, WKBElement]
         return to_shape(geom)
 
 
+def point_geojson_feature(title: str, path: str, point: BaseGeometry) -> Dict:
+    return {
+        'type': 'Feature',
+        'properties': {'title': title, 'path': path},
+        'geometry': shapely_mapping(point),
+    }
+
+
+def maps_point_query(point: BaseGeometry) -> str:
+    return f'{point.y:.6f},{point.x:.6f}'
+
+
 SHORT_NAME_RE = r'[a-zA-Z][a-zA-Z0-9_-]+'
 
 PAGE_LINK_RE = r'\[([^]]+)]\((?:/tourist)?/page/([^)]+)\)'
 
 WIKI_LINK_RE = r'\[\[' + SHORT_NAME_RE + r'\]\]'
 
+WIKI_LINK_TARGET_RE = r'\[\[(' + SHORT_NAME_RE + r')\]\]'
+
+
+@functools.lru_cache(maxsize=4096)
+def wiki_link_targets(markdown: Optional[str]) -> FrozenSet[str]:
+    """Returns the short_name in each [[wiki-link]] of `markdown`. Results are cached by markdown
+    so each version of a club's text is only parsed once."""
+    if not markdown:
+        return frozenset()
+    return frozenset(re.findall(WIKI_LINK_TARGET_RE, markdown))
+
+
 def _validate_short_name(short_name):
     if not re.fullmatch(SHORT_NAME_RE, short_name):
         raise ValueError(
@@ -164,11 +192,7 @@ class Place(db.Model, Entity):
             return {}
         else:
             polygon = to_shape(self.region)
-            return {
-                'type': 'Feature',
-                'properties': {'title': self.name, 'path': self.path},
-                'geometry': shapely_mapping(polygon.centroid),
-            }
+            return point_geojson_feature(self.name, self.path, polygon.centroid)
 
     @property
     def _pool_geojson_features(self) -> List[Dict]:
@@ -192,16 +216,17 @@ class Place(db.Model, Entity):
         else:
             return []
 
-    def as_attrib_entity(self):
+    def as_attrib_entity(self, geometry_to_shape=optional_geometry_to_shape):
         parent_short_name = self.parent and self.parent.short_name or ''
-        return place_as_attrib_entity(self, parent_short_name)
+        return place_as_attrib_entity(self, parent_short_name, geometry_to_shape)
 
     @property
     def is_world(self) -> bool:
         return self.short_name == 'world'
 
 
-def place_as_attrib_entity(place, parent_short_name: str):
+def place_as_attrib_entity(place, parent_short_name: str,
+                           geometry_to_shape=optional_geometry_to_shape):
     return attrib.Entity(
         type='place',
         id=place.id,
@@ -209,7 +234,7 @@ def place_as_attrib_entity(place, parent_short_name: str):
         short_name=place.short_name,
         markdown=place.markdown,
         parent_short_name=parent_short_name,
-        region=optional_geometry_to_shape(place.region),
+        region=geometry_to_shape(place.region),
         geonames_id=place.geonames_id,
         status_comment=place.status_comment,
         status_date=place.status_date or None,
@@ -270,11 +295,14 @@ class Club(db.Model, Entity):
     # status_date is not set for clubs with source_short_name because we don't know when it was
     # last checked or verified.
     status_date = db.Column(db.String, nullable=True)
+    # status_date as a date when it is a valid YYYY-MM-DD, kept in sync by `_set_status_date` and
+    # indexed to find recently updated clubs. It is derived so it isn't in the version history.
+    status_date_parsed = db.Column(db.Date, nullable=True, index=True)
     source_short_name = db.Column(db.String, nullable=True)
     source_key = db.Column(db.String, nullable=True)
     logo_url = db.Column(db.String, nullable=True)
 
-    __versioned__ = {}
+    __versioned__ = {'exclude': ['status_date_parsed']}
 
     def __str__(self):
         if self.parent:
@@ -296,6 +324,16 @@ class Club(db.Model, Entity):
             except ValueError:
                 raise ValueError("status_date must be a date in ISO YYYY-MM-DD format")
 
+    @sqlalchemy.orm.validates('status_date')
+    def _set_status_date(self, key, status_date):
+        self.status_date_parsed = None
+        if status_date and re.fullmatch(r'\d{4}-\d{2}-\d{2}', status_date):
+            try:
+                self.status_date_parsed = datetime.date.fromisoformat(status_date)
+            except ValueError:
+                pass
+        return status_date
+
     @property
     def status_datetime(self):
         # status_date is always YYYY-MM-DD so a datetime.date makes sense but there are already some places that
@@ -347,13 +385,10 @@ class Pool(db.Model, Entity):
 
     @property
     def club_back_links(self) -> List[Club]:
-        """Returns clubs that have the same parent as and a [[wiki-link]] to, this pool."""
-        clubs = []
-        link_text = f'[[{self.short_name}]]'
-        for club in self.parent.child_clubs:
-            if club.markdown and link_text in club.markdown:
-                clubs.append(club)
-        return clubs
+        """Returns clubs that have the same parent as and a [[wiki-link]] to, this pool. Use
+        ClubBackLinkIndex when finding the back links of many pools."""
+        return [club for club in self.parent.child_clubs
+                if self.short_name in wiki_link_targets(club.markdown)]
 
     def __str__(self):
         if self.parent:
@@ -367,11 +402,7 @@ class Pool(db.Model, Entity):
         if self.entrance is None:
             return {}
         else:
-            return {
-                'type': 'Feature',
-                'properties': {'title': self.name, 'path': self.path},
-                'geometry': shapely_mapping(to_shape(self.entrance)),
-            }
+            return point_geojson_feature(self.name, self.path, to_shape(self.entrance))
 
     @property
     def has_entrance_and_club_back_links(self) -> bool:
@@ -385,8 +416,7 @@ class Pool(db.Model, Entity):
     def maps_point_query(self) -> str:
         if self.entrance is None:
             return 'Please add pool location'
-        entrance_shapely = to_shape(self.entrance)
-        return f'{entrance_shapely.y:.6f},{entrance_shapely.x:.6f}'
+        return maps_point_query(to_shape(self.entrance))
 
     @property
     def path(self) -> str:
@@ -395,11 +425,29 @@ class Pool(db.Model, Entity):
         #return self.parent.path + '#' + self.short_name
         return self.parent.path
 
-    def as_attrib_entity(self):
-        return pool_as_attrib_entity(self, self.parent.short_name)
+    def as_attrib_entity(self, geometry_to_shape=optional_geometry_to_shape):
+        return pool_as_attrib_entity(self, self.parent.short_name, geometry_to_shape)
+
 
+@attr.s(auto_attribs=True, frozen=True)
+class ClubBackLinkIndex:
+    """The `Pool.club_back_links` of every pool, found with one pass over the clubs."""
+    clubs_by_parent_and_target: Dict[Tuple[Place, str], List[Club]]
 
-def pool_as_attrib_entity(pool, parent_short_name):
+    @staticmethod
+    def build(places: Iterable[Place]) -> 'ClubBackLinkIndex':
+        clubs_by_parent_and_target = defaultdict(list)
+        for place in places:
+            for club in place.child_clubs:
+                for target in wiki_link_targets(club.markdown):
+                    clubs_by_parent_and_target[(place, target)].append(club)
+        return ClubBackLinkIndex(dict(clubs_by_parent_and_target))
+
+    def club_back_links(self, pool: Pool) -> List[Club]:
+        return self.clubs_by_parent_and_target.get((pool.parent, pool.short_name), [])
+
+
+def pool_as_attrib_entity(pool, parent_short_name, geometry_to_shape=optional_geometry_to_shape):
     return attrib.Entity(
         type='pool',
         id=pool.id,
@@ -407,7 +455,7 @@ def pool_as_attrib_entity(pool, parent_short_name):
         short_name=pool.short_name,
         markdown=pool.markdown,
         parent_short_name=parent_short_name,
-        point=optional_geometry_to_shape(pool.entrance),
+        point=geometry_to_shape(pool.entrance),
         status_comment=pool.status_comment,
         status_date=pool.status_date or None,
     )
@@ -416,6 +464,11 @@ def pool_as_attrib_entity(pool, parent_short_name):
 from sqlalchemy.types import TypeDecorator, VARCHAR
 import json
 
+def json_dumps_compact(value) -> str:
+    """Returns `value` encoded as JSON without whitespace, the format stored by JSONEncodedDict."""
+    return json.dumps(value, indent=None, separators=(',', ':'))
+
+
 class JSONEncodedDict(TypeDecorator):
     """Represents an immutable structure as a json-encoded string.
     Usage::
@@ -427,7 +480,7 @@ class JSONEncodedDict(TypeDecorator):
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = json.dumps(value, indent=None, separators=(',', ':'))
+            value = json_dumps_compact(value)
         return value
 
     def process_result_value(self, value, dialect):
@@ -461,17 +514,60 @@ class PlaceComment(db.Model, EntityChild):
 
     place = db.relationship("Place", back_populates="comments")
 
+    # For the /comments pages, which are in (timestamp, id) order and filtered by spam status or
+    # place.
+    __table_args__ = (
+        db.Index('ix_place_comment_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_place_comment_spam_status_timestamp_id', 'akismet_spam_status', 'timestamp',
+                 'id'),
+        db.Index('ix_place_comment_place_id_timestamp_id', 'place_id', 'timestamp', 'id'),
+    )
+
 
 class RenderCache(db.Model):
     """A key-value store that caches data derived from other tables and passed to HTML templates.
 
-    The value_dict contains JSON representations of structures in models/render.py. It'd make sense to store this
-    in its owne key-value store, separate from tstore but I haven't set that up.
+    The value_dict contains JSON representations of structures in models/render.py. The rows are
+    read and written through `render_store.RenderStore`, which keeps them in this table of
+    tourist.db or, when RENDER_CACHE_SQLITE_PATH is set, in a separate SQLite file.
+
+    Each build writes rows in a new RenderCacheGeneration, which is activated once every row is
+    written. Readers use the row with the largest activated generation for a name so they never
+    see a partly written build. Rows hidden by newer ones are removed by
+    `render_store.RenderStore.collect_garbage`.
     """
-    name = db.Column(db.String, primary_key=True, nullable=False, unique=True,
-                     sqlite_on_conflict_primary_key='REPLACE')
+    name = db.Column(db.String, primary_key=True, nullable=False)
+    generation = db.Column(db.Integer, db.ForeignKey('render_cache_generation.generation'),
+                           primary_key=True, nullable=False)
+    # Set on a row recording that the name was removed in this generation.
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
     value_str = db.Column(db.String)
     value_dict = db.Column(JSONEncodedDict)
+    # Hash of value_str or the JSON of value_dict, used as the HTTP ETag.
+    content_hash = db.Column(db.String, nullable=True)
+    build_timestamp = db.Column(db.DateTime(), nullable=True)
+    # Compressed copies of value_str, only set for large values sent as they are.
+    value_gzip = db.Column(db.LargeBinary, nullable=True)
+    value_br = db.Column(db.LargeBinary, nullable=True)
+
+
+class RenderCacheDirty(db.Model):
+    """A marker that the RenderCache needs to be updated, added after a commit when the render
+    cache is updated in the background. The worker rebuilds once for all markers it finds."""
+    id = db.Column(db.Integer, primary_key=True)
+    # List of `render_factory.entity_key` strings or None to rebuild every row.
+    entity_keys = db.Column(JSONEncodedDict, nullable=True)
+    timestamp = db.Column(db.DateTime(), default=datetime.datetime.utcnow)
+
+
+class RenderCacheGeneration(db.Model):
+    """A row is added when an update of the RenderCache starts writing rows and
+    `activated_timestamp` is set when the update goes live. The largest activated generation is
+    the current one."""
+    __table_args__ = {'sqlite_autoincrement': True}
+    generation = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime(), default=datetime.datetime.utcnow)
+    activated_timestamp = db.Column(db.DateTime(), nullable=True, index=True)
 
 
 sqlalchemy.orm.configure_mappers()
\ No newline at end of file
@@ -1,25 +1,56 @@
+import codecs
+import collections
+import concurrent.futures
+import contextlib
 import csv
 import datetime
 import enum
+import functools
+import gzip
+import hashlib
 import io
 import itertools
+import json
 import logging
+import multiprocessing
+import resource
+import threading
+import time
+import tracemalloc
+import zlib
 from collections import defaultdict
+from typing import AbstractSet
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
 from typing import List, Mapping
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Type
 from typing import Union
 
 from more_itertools import one
+from shapely.geometry import box as shapely_box
 from shapely.geometry import mapping as shapely_mapping
+from shapely.geometry import shape as shapely_shape
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 
+import flask
+import sqlalchemy
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.util import IdentitySet
 
 import attrs
+import brotli
 import cattrs
 import geojson
-from geoalchemy2.shape import to_shape
 
 from tourist import continuumutils
+from tourist import markdown_html
+from tourist import render_store
 from tourist.models import render
 from tourist.models import tstore
 
@@ -28,10 +59,218 @@ from tourist.models import tstore
 class RenderName(enum.Enum):
     PLACE_PREFIX = "/place/"
     PLACE_NAMES_WORLD = "/place_names_world"
+    SHORT_NAMES = "/short_names"
     CSV_ALL = "/csv"
     POOLS_GEOJSON = "/pools.geojson"
     BE_GEOJSON = "/be.geojson"
     PROBLEMS = "/problems_list"
+    DEPENDENCIES = "/dependencies"
+
+
+# Rows with a value_str that is sent as it is in a response. These are stored compressed too.
+COMPRESSED_NAMES = frozenset([RenderName.POOLS_GEOJSON, RenderName.BE_GEOJSON,
+                              RenderName.CSV_ALL])
+# Content-Encoding values of the compressed copies, in order of preference.
+COMPRESSED_ENCODINGS = ('br', 'gzip')
+
+
+def place_cache_name(short_name: str) -> str:
+    """Returns the name of the RenderCache row for the place page of `short_name`."""
+    return RenderName.PLACE_PREFIX.value + short_name
+
+
+def entity_key(entity: Union[tstore.Entity, tstore.EntityChild]) -> str:
+    """Returns a string identifying `entity` in `CacheDependencies`, such as 'club/12'."""
+    return f'{type(entity).__name__.lower()}/{entity.id}'
+
+
+@attrs.frozen()
+class CacheDependencies:
+    """Names of the RenderCache rows that are built from each entity, keyed by `entity_key`.
+
+    A copy is stored in the RenderCache so that after a change to some entities only the rows
+    built from the old and new versions of them need to be rebuilt.
+    """
+    names_by_entity: Dict[str, List[str]] = attrs.field(factory=dict)
+
+    def names_for(self, entity_keys: Iterable[str]) -> Set[str]:
+        names = set()
+        for key in entity_keys:
+            names.update(self.names_by_entity.get(key, ()))
+        return names
+
+
+def _build_dependencies(all_places: List[tstore.Place], all_clubs: List[tstore.Club],
+                        all_pools: List[tstore.Pool], all_comments: List[tstore.PlaceComment],
+                        all_sources: List[tstore.Source]) -> CacheDependencies:
+    names_by_entity = defaultdict(set)
+
+    def _place_and_parents(place: Optional[tstore.Place]) -> List[tstore.Place]:
+        return [place, *place.parents] if place else []
+
+    def _add_place_and_parent_pages(key: str, place: Optional[tstore.Place]):
+        for p in _place_and_parents(place):
+            names_by_entity[key].add(place_cache_name(p.short_name))
+            if p.short_name == 'be':
+                names_by_entity[key].add(RenderName.BE_GEOJSON.value)
+
+    for place in all_places:
+        key = entity_key(place)
+        # The geojson of every parent includes this place and its name is in the page of
+        # every descendant.
+        _add_place_and_parent_pages(key, place)
+        for parent in place.parents:
+            names_by_entity[entity_key(parent)].add(place_cache_name(place.short_name))
+        names_by_entity[key].update([RenderName.PLACE_NAMES_WORLD.value,
+                                     RenderName.POOLS_GEOJSON.value, RenderName.CSV_ALL.value,
+                                     RenderName.PROBLEMS.value, RenderName.SHORT_NAMES.value])
+    for club in all_clubs:
+        key = entity_key(club)
+        _add_place_and_parent_pages(key, club.parent)
+        names_by_entity[key].update([RenderName.PLACE_NAMES_WORLD.value,
+                                     RenderName.POOLS_GEOJSON.value, RenderName.CSV_ALL.value,
+                                     RenderName.PROBLEMS.value, RenderName.SHORT_NAMES.value])
+    # The name of a pool is in the HTML converted from every markdown with a [[WikiLink]] to it,
+    # which is on the page of the place of the markdown.
+    wiki_link_pages = defaultdict(set)
+    markdown_places = itertools.chain(
+        ((p.markdown, p) for p in all_places),
+        ((c.markdown, c.parent) for c in all_clubs),
+        ((p.markdown, p.parent) for p in all_pools),
+        ((c.content_markdown, c.place) for c in all_comments))
+    for markdown, place in markdown_places:
+        if place and markdown:
+            for target in tstore.wiki_link_targets(markdown):
+                wiki_link_pages[target].add(place_cache_name(place.short_name))
+    for pool in all_pools:
+        key = entity_key(pool)
+        _add_place_and_parent_pages(key, pool.parent)
+        names_by_entity[key].update(wiki_link_pages[pool.short_name])
+        names_by_entity[key].update([RenderName.PLACE_NAMES_WORLD.value,
+                                     RenderName.POOLS_GEOJSON.value, RenderName.CSV_ALL.value,
+                                     RenderName.SHORT_NAMES.value])
+    for comment in all_comments:
+        key = entity_key(comment)
+        if comment.place:
+            names_by_entity[key].add(place_cache_name(comment.place.short_name))
+        names_by_entity[key].add(RenderName.PLACE_NAMES_WORLD.value)
+    for source in all_sources:
+        key = entity_key(source)
+        # recently_updated on the world page and every page with a club from the source.
+        names_by_entity[key].add(place_cache_name('world'))
+        for club in all_clubs:
+            if club.source_short_name == source.source_short_name and club.parent:
+                names_by_entity[key].add(place_cache_name(club.parent.short_name))
+
+    return CacheDependencies(names_by_entity={key: sorted(names) for key, names in
+                                              names_by_entity.items()})
+
+
+@attrs.define(slots=False)
+class DecodedGeometry:
+    """A shapely geometry with the values derived from it computed when first used."""
+    shape: BaseGeometry
+
+    @functools.cached_property
+    def bounds(self) -> render.Bounds:
+        (minx, miny, maxx, maxy) = self.shape.bounds
+        return render.Bounds(north=maxy, south=miny, west=minx, east=maxx)
+
+    @functools.cached_property
+    def centroid(self) -> BaseGeometry:
+        return self.shape.centroid
+
+    @functools.cached_property
+    def area(self) -> float:
+        return self.shape.area
+
+
+@attrs.define()
+class GeometryMemo:
+    """Place.region and Pool.entrance values decoded once per build and shared by everything that
+    uses them."""
+    decoded: Dict[int, Tuple[Any, DecodedGeometry]] = attrs.field(factory=dict)
+
+    def get(self, geom) -> Optional[DecodedGeometry]:
+        if geom is None:
+            return None
+        entry = self.decoded.get(id(geom))
+        if entry is None:
+            # `geom` is kept so that its id isn't reused by another object during the build.
+            entry = (geom, DecodedGeometry(tstore.optional_geometry_to_shape(geom)))
+            self.decoded[id(geom)] = entry
+        return entry[1]
+
+    def shape(self, geom) -> Optional[BaseGeometry]:
+        decoded = self.get(geom)
+        return None if decoded is None else decoded.shape
+
+    def area(self, place: tstore.Place) -> float:
+        decoded = self.get(place.region)
+        # Area is in degrees^2, fairly meaningless beyond ranking places
+        return 0 if decoded is None else decoded.area
+
+    def center_geojson_feature(self, place: tstore.Place) -> Dict:
+        decoded = self.get(place.region)
+        if decoded is None:
+            return {}
+        return tstore.point_geojson_feature(place.name, place.path, decoded.centroid)
+
+    def entrance_geojson_feature(self, pool: tstore.Pool) -> Dict:
+        decoded = self.get(pool.entrance)
+        if decoded is None:
+            return {}
+        return tstore.point_geojson_feature(pool.name, pool.path, decoded.shape)
+
+    def maps_point_query(self, pool: tstore.Pool) -> str:
+        decoded = self.get(pool.entrance)
+        if decoded is None:
+            return 'Please add pool location'
+        return tstore.maps_point_query(decoded.shape)
+
+
+@attrs.define()
+class GeojsonFeatures:
+    """Map features of places and pools, each built once per build and shared by the place pages
+    that show them and POOLS_GEOJSON. The features of a place are made from the already computed
+    lists of its children so each subtree is visited once, not once per ancestor."""
+    geometry: GeometryMemo
+    back_links: tstore.ClubBackLinkIndex
+    pool_features: Dict[tstore.Pool, Dict] = attrs.field(factory=dict)
+    center_features: Dict[tstore.Place, Dict] = attrs.field(factory=dict)
+    children_features: Dict[tstore.Place, List[Dict]] = attrs.field(factory=dict)
+
+    def pool_feature(self, pool: tstore.Pool) -> Dict:
+        """Returns the entrance feature of `pool` or an empty dict if it doesn't have an entrance
+        and club back links."""
+        if pool not in self.pool_features:
+            feature = self.geometry.entrance_geojson_feature(pool)
+            if not self.back_links.club_back_links(pool):
+                feature = {}
+            self.pool_features[pool] = feature
+        return self.pool_features[pool]
+
+    def center_feature(self, place: tstore.Place) -> Dict:
+        if place not in self.center_features:
+            self.center_features[place] = self.geometry.center_geojson_feature(place)
+        return self.center_features[place]
+
+    def children_geojson_features(self, place: tstore.Place) -> List[Dict]:
+        """Same as `Place.children_geojson_features`."""
+        if place not in self.children_features:
+            pool_features = [self.pool_feature(p) for p in place.child_pools
+                             if self.pool_feature(p)]
+            if pool_features or place.child_places:
+                features = pool_features + list(itertools.chain.from_iterable(
+                    self.children_or_center_geojson_features(c) for c in place.child_places))
+            else:
+                features = []
+            self.children_features[place] = features
+        return self.children_features[place]
+
+    def children_or_center_geojson_features(self, place: tstore.Place) -> List[Dict]:
+        """Same as `Place.children_or_center_geojson_features`."""
+        return self.children_geojson_features(place) or [self.center_feature(place)]
 
 
 def _build_render_club_source(orm_source: tstore.Source) -> render.ClubSource:
@@ -42,7 +281,8 @@ def _build_render_club_source(orm_source: tstore.Source) -> render.ClubSource:
     )
 
 
-def _build_render_club(orm_club: tstore.Club, source_by_short_name: Mapping[str, render.ClubSource]) -> render.Club:
+def _build_render_club(orm_club: tstore.Club, source_by_short_name: Mapping[str, render.ClubSource],
+                       to_html: markdown_html.MarkdownToHtml) -> render.Club:
     source = source_by_short_name.get(orm_club.source_short_name, None)
     return render.Club(
         id=orm_club.id,
@@ -52,12 +292,15 @@ def _build_render_club(orm_club: tstore.Club, source_by_short_name: Mapping[str,
         status_date=orm_club.status_date,
         logo_url=orm_club.logo_url,
         source=source,
+        markdown_html=to_html.convert(orm_club.markdown),
     )
 
 
-def _build_render_pool(orm_pool: tstore.Pool) -> render.Pool:
+def _build_render_pool(orm_pool: tstore.Pool, geometry: GeometryMemo,
+                       back_links: tstore.ClubBackLinkIndex,
+                       to_html: markdown_html.MarkdownToHtml) -> render.Pool:
     club_back_links = [render.ClubShortNameName(short_name=c.short_name, name=c.name)
-                       for c in orm_pool.club_back_links]
+                       for c in back_links.club_back_links(orm_pool)]
 
     return render.Pool(
         id=orm_pool.id,
@@ -65,38 +308,57 @@ def _build_render_pool(orm_pool: tstore.Pool) -> render.Pool:
         short_name=orm_pool.short_name,
         markdown=orm_pool.markdown,
         club_back_links=club_back_links,
-        maps_point_query=orm_pool.maps_point_query,
+        maps_point_query=geometry.maps_point_query(orm_pool),
+        markdown_html=to_html.convert(orm_pool.markdown),
     )
 
 
-def _build_changes(orm_entity: Union[tstore.Place, tstore.Club, tstore.Pool], versions:
-        continuumutils.VersionTables) -> (render.PlaceEntityChanges):
-    changes = render.PlaceEntityChanges(entity_name=orm_entity.name)
+# Clubs with the newest status_date shown on the world page
+RECENTLY_UPDATED_CLUB_COUNT = 5
 
-    prev_v = None
-    for v in versions.get_object_history(orm_entity):
-        issued_at = versions.transaction_issued_at[v.transaction_id]
-        user_email = versions.transaction_user_email.get(v.transaction_id, None)
-        changes.changes.append(render.PlaceEntityChanges.Change(
-            timestamp=issued_at, user=user_email,
-            change=str(continuumutils.changeset(v, prev_v))))
-        prev_v = v
-    return changes
+
+def build_recently_updated() -> List[render.RecentlyUpdated]:
+    """Returns the clubs with the newest status_date and every source with a place, newest first.
+    They are read with one indexed query for clubs and one for sources so this doesn't need a
+    snapshot or rebuild of the render cache."""
+    recently_updated = []
+    clubs = tstore.db.session.query(tstore.Club).join(tstore.Club.parent).options(
+        sqlalchemy.orm.contains_eager(tstore.Club.parent)).filter(
+        tstore.Club.status_date_parsed.isnot(None)).order_by(
+        tstore.Club.status_date_parsed.desc()).limit(RECENTLY_UPDATED_CLUB_COUNT)
+    for club in clubs:
+        recently_updated.append(render.RecentlyUpdated(
+            timestamp=club.status_datetime, path=club.path, club_name=club.name,
+            place_name=club.parent.name))
+    sources = tstore.db.session.query(tstore.Source, tstore.Place).join(
+        tstore.Place, tstore.Place.id == tstore.Source.place_id)
+    for source, place in sources:
+        recently_updated.append(render.RecentlyUpdated(
+            timestamp=source.sync_timestamp, path=place.path, place_name=place.name,
+            source_name=source.name))
+    recently_updated.sort(key=lambda ru: ru.timestamp, reverse=True)
+    return recently_updated
 
 
 def _build_render_place(orm_place: tstore.Place, source_by_short_name: Mapping[str,
-      render.ClubSource], versions: continuumutils.VersionTables) -> (render.Place):
-    children_geojson = orm_place.children_geojson_features
+      render.ClubSource], geometry: GeometryMemo, back_links: tstore.ClubBackLinkIndex,
+                        features: GeojsonFeatures, to_html: markdown_html.MarkdownToHtml) \
+        -> render.Place:
+    children_geojson = features.children_geojson_features(orm_place)
     if children_geojson:
         geojson_children_collection = geojson.FeatureCollection(children_geojson)
     else:
         geojson_children_collection = {}
 
-    child_clubs = [_build_render_club(c, source_by_short_name) for c in orm_place.child_clubs]
-    child_pools = [_build_render_pool(p) for p in orm_place.child_pools]
+    child_clubs = [_build_render_club(c, source_by_short_name, to_html)
+                   for c in orm_place.child_clubs]
+    child_pools = [_build_render_pool(p, geometry, back_links, to_html)
+                   for p in orm_place.child_pools]
     child_places = [render.ChildPlace(p.path, p.name) for p in orm_place.child_places]
     comments = [render.PlaceComment(id=c.id, timestamp=c.timestamp, content=c.content,
                                     content_markdown=c.content_markdown,
+                                    content_html=(to_html.convert(c.content_markdown)
+                                                  if c.content_markdown else None),
                                     source=c.source) for c in orm_place.comments]
 
     parents = []
@@ -105,41 +367,13 @@ def _build_render_place(orm_place: tstore.Place, source_by_short_name: Mapping[s
         parents.append(render.ChildPlace(p.path, p.name))
         p = p.parent
 
-    bounds = None
-    if orm_place.bounds is not None:
-        polygon = to_shape(orm_place.region)
-        (minx, miny, maxx, maxy) = polygon.bounds
-        bounds = render.Bounds(
-            north=maxy,
-            south=miny,
-            west=minx,
-            east=maxx
-        )
+    region = geometry.get(orm_place.region)
+    bounds = None if region is None else region.bounds
 
     if orm_place.is_world:
-        club: tstore.Club
-        recently_updated = []
-        for club in tstore.db.session.query(tstore.Club).filter(tstore.Club.status_date.like('____-__-__')).order_by(tstore.Club.status_date.desc()).limit(5):
-            recently_updated.append(render.RecentlyUpdated(
-                timestamp=club.status_datetime, path=club.path, club_name=club.name, place_name=club.parent.name))
-        source: tstore.Source
-        for source in tstore.db.session.query(tstore.Source).all():
-            if not source.place_id:
-                continue
-            place: tstore.Place = tstore.db.session.get(tstore.Place, source.place_id)
-            if not place:
-                continue
-            recently_updated.append(render.RecentlyUpdated(
-                timestamp=source.sync_timestamp, path=place.path, place_name=place.name, source_name=source.name))
-        recently_updated.sort(key=lambda ru: ru.timestamp, reverse=True)
-        entity_changes = None
+        recently_updated = build_recently_updated()
     else:
         recently_updated = None
-        entity_changes = [_build_changes(orm_place, versions)]
-        for child in itertools.chain(orm_place.child_places, orm_place.child_pools,
-                                           orm_place.child_clubs):
-            entity_changes.append(_build_changes(child, versions))
-
 
     return render.Place(
         id=orm_place.id,
@@ -154,17 +388,19 @@ def _build_render_place(orm_place: tstore.Place, source_by_short_name: Mapping[s
         parents=parents,
         recently_updated=recently_updated,
         comments=comments,
-        changes=entity_changes,
+        markdown_html=to_html.convert(orm_place.markdown),
     )
 
 
-def _build_place_recursive_names(orm_place: tstore.Place) \
+def _build_place_recursive_names(orm_place: tstore.Place, geometry: GeometryMemo,
+                                 back_links: tstore.ClubBackLinkIndex) \
         -> render.PlaceRecursiveNames:
-    child_places = [_build_place_recursive_names(p) for p in orm_place.child_places]
+    child_places = [_build_place_recursive_names(p, geometry, back_links)
+                    for p in orm_place.child_places]
     child_clubs = [render.PlaceRecursiveNames.Club(c.name) for c in orm_place.child_clubs]
     pool_by_has_links = defaultdict(list)
     for p in orm_place.child_pools:
-        pool_by_has_links[bool(p.club_back_links)].append(p)
+        pool_by_has_links[bool(back_links.club_back_links(p))].append(p)
     pools_with_links = pool_by_has_links[True]
     pools_without_links = pool_by_has_links[False]
     child_pools_with_club_back_links = [render.PlaceRecursiveNames.Pool(p.name) for p in
@@ -175,7 +411,7 @@ def _build_place_recursive_names(orm_place: tstore.Place) \
         id=orm_place.id,
         name=orm_place.name,
         path=orm_place.path,
-        area=orm_place.area,
+        area=geometry.area(orm_place),
         child_clubs=child_clubs,
         child_pools=child_pools_with_club_back_links,
         child_pools_without_club_back_links=child_pools_without_club_back_links,
@@ -184,30 +420,29 @@ def _build_place_recursive_names(orm_place: tstore.Place) \
     )
 
 
-def _build_geojson_feature_collection(all_places, all_pools):
-    pools_for_geojson = [p for p in all_pools if p.has_entrance_and_club_back_links]
-    geojson_features = [p.entrance_geojson_feature for p in pools_for_geojson]
+def _build_geojson_feature_collection(all_places, all_pools, features: GeojsonFeatures):
+    pools_for_geojson = [p for p in all_pools if features.pool_feature(p)]
+    geojson_features = [features.pool_feature(p) for p in pools_for_geojson]
     set_pools_for_geojson = set(pools_for_geojson)
     for p in all_places:
         if p.child_places or len(set(p.child_pools).intersection(set_pools_for_geojson)):
             continue
-        geojson_features.append(p.center_geojson_feature)
+        geojson_features.append(features.center_feature(p))
     geojson_feature_collection = geojson.FeatureCollection(geojson_features)
     return geojson_feature_collection
 
 
-def _build_be_geojson_feature_collection(be_place: tstore.Place):
+def _build_be_geojson_feature_collection(be_place: tstore.Place, geometry: GeometryMemo):
     """Returns a GeoJSON FeatureCollection especially for belgiumuwh.be"""
     geojson_features = []
     for town in be_place.child_places:
-        polygon = to_shape(town.region)
         clubs = list(town.child_clubs)
         if len(clubs) == 1:
             club = one(clubs)
             geojson_features.append({
                 'type': 'Feature',
                 'properties': {'title': club.name},
-                'geometry': shapely_mapping(polygon.centroid),
+                'geometry': shapely_mapping(geometry.get(town.region).centroid),
             })
         else:
             # TODO(TomGoBravo): Log this to something like sentry so it isn't buried in a log file.
@@ -222,12 +457,22 @@ class StatusDateClub:
     club: tstore.Club = attrs.field(order=False)
 
 
-def _build_problems(all_places: List[tstore.Place], all_clubs: List[tstore.Club]) -> List[
-    render.Problem]:
+def _build_short_names(all_places: List[tstore.Place], all_clubs: List[tstore.Club],
+                       all_pools: List[tstore.Pool]) -> render.ShortNames:
+    targets = defaultdict(list)
+    for type_name, entities in (('pool', all_pools), ('club', all_clubs), ('place', all_places)):
+        for entity in entities:
+            if type_name == 'place' or entity.parent:
+                targets[entity.short_name].append(render.ShortNames.Target(type_name, entity.path))
+    return render.ShortNames(dict(targets))
+
+
+def _build_problems(all_places: List[tstore.Place], all_clubs: List[tstore.Club],
+                    geometry: GeometryMemo) -> List[render.Problem]:
     """Returns a list of data quality problems found in the places and clubs."""
     problems = []
     for place in all_places:
-        if place.area == 0 and not place.is_world:
+        if geometry.area(place) == 0 and not place.is_world:
             problems.append(render.Problem(place.path,
                                            place.name,
                                            "Add place location as a polygon on the map"))
@@ -255,77 +500,695 @@ def _build_problems(all_places: List[tstore.Place], all_clubs: List[tstore.Club]
     return problems
 
 
-def yield_cache():
-    def get_all(cls):
-        all_objects = IdentitySet(cls.query.all()) | tstore.db.session.dirty | tstore.db.session.new
-        all_objects -= tstore.db.session.deleted
-        return list(filter(lambda obj: isinstance(obj, cls), all_objects))
+def _get_all(cls):
+    all_objects = IdentitySet(cls.query.all()) | tstore.db.session.dirty | tstore.db.session.new
+    all_objects -= tstore.db.session.deleted
+    return list(filter(lambda obj: isinstance(obj, cls), all_objects))
+
+
+def _set_unloaded_collections(parents: List, attribute: str, children: List,
+                              get_parent: Callable[[Any], Any]):
+    """Sets collection `attribute` of each object in `parents` that hasn't been loaded to the
+    `children` with that parent, as a lazy load would after a flush."""
+    children_by_parent = defaultdict(list)
+    for child in children:
+        parent = get_parent(child)
+        if parent is not None:
+            children_by_parent[parent].append(child)
+    for parent in parents:
+        if attribute in sqlalchemy.inspect(parent).unloaded:
+            set_committed_value(parent, attribute, children_by_parent[parent])
+
+
+@attrs.frozen()
+class WorldSnapshot:
+    """Every entity used to build the RenderCache. The relationships walked while building are
+    populated from these lists so the build doesn't lazy load them one place at a time."""
+    places: List[tstore.Place]
+    clubs: List[tstore.Club]
+    pools: List[tstore.Pool]
+    comments: List[tstore.PlaceComment]
+    sources: List[tstore.Source]
+
+    @property
+    def entity_count(self) -> int:
+        return (len(self.places) + len(self.clubs) + len(self.pools) + len(self.comments) +
+                len(self.sources))
+
+    def get_place(self, short_name: str) -> Optional[tstore.Place]:
+        return next((p for p in self.places if p.short_name == short_name), None)
+
+
+def load_subtree_snapshot(short_name: str) -> Optional[WorldSnapshot]:
+    """Loads place `short_name` and all its descendants, without loading the rest of the world.
+    The ids of the places are found with a recursive query on `parent_id` and the entities in
+    them are loaded with one query for each model. Returns None if there is no such place."""
+    session = tstore.db.session
+    subtree_ids = session.query(tstore.Place.id).filter(
+        tstore.Place.short_name == short_name).cte(name='subtree_ids', recursive=True)
+    subtree_ids = subtree_ids.union(session.query(tstore.Place.id).filter(
+        tstore.Place.parent_id == subtree_ids.c.id))
+    ids_select = sqlalchemy.select(subtree_ids.c.id)
+    places = tstore.Place.query.filter(tstore.Place.id.in_(ids_select)).all()
+    if not places:
+        return None
+    return WorldSnapshot(
+        places=places,
+        clubs=tstore.Club.query.filter(tstore.Club.parent_id.in_(ids_select)).all(),
+        pools=tstore.Pool.query.filter(tstore.Pool.parent_id.in_(ids_select)).all(),
+        comments=tstore.PlaceComment.query.filter(
+            tstore.PlaceComment.place_id.in_(ids_select)).all(),
+        sources=tstore.Source.query.filter(tstore.Source.place_id.in_(ids_select)).all())
+
+
+def load_snapshot() -> WorldSnapshot:
+    """Loads a WorldSnapshot with one query for each model. Many-to-one relationships such as
+    `parent` are found in the session identity map without a query once every place is loaded."""
+    snapshot = WorldSnapshot(places=_get_all(tstore.Place), clubs=_get_all(tstore.Club),
+                             pools=_get_all(tstore.Pool), comments=_get_all(tstore.PlaceComment),
+                             sources=_get_all(tstore.Source))
+    _set_unloaded_collections(snapshot.places, 'child_places', snapshot.places,
+                              lambda p: p.parent)
+    _set_unloaded_collections(snapshot.places, 'child_clubs', snapshot.clubs, lambda c: c.parent)
+    _set_unloaded_collections(snapshot.places, 'child_pools', snapshot.pools, lambda p: p.parent)
+    _set_unloaded_collections(snapshot.places, 'comments', snapshot.comments, lambda c: c.place)
+    return snapshot
+
+
+def get_affected_names(changed_entity_keys: AbstractSet[str]) -> Optional[Set[str]]:
+    """Returns names of the RenderCache rows built from the changed entities or None if every row
+    needs to be rebuilt.
+
+    Both the stored dependencies, from before the change, and the dependencies of the entities
+    as they are now are used so that moving an entity rebuilds the rows of the old and new place.
+    """
+    stored_dependencies = render_store.get_store().get_current(
+        RenderName.DEPENDENCIES.value, tstore.RenderCache.value_dict)
+    if stored_dependencies is None:
+        return None
+    old_dependencies = cattrs.structure(stored_dependencies.value_dict, CacheDependencies)
+    snapshot = load_snapshot()
+    new_dependencies = _build_dependencies(snapshot.places, snapshot.clubs, snapshot.pools,
+                                           snapshot.comments, snapshot.sources)
+    return (old_dependencies.names_for(changed_entity_keys) |
+            new_dependencies.names_for(changed_entity_keys))
+
+
+def _make_cache_row(build_timestamp: datetime.datetime, name: str, value_str: Optional[str] = None,
+                    value_dict: Optional[Dict] = None) -> tstore.RenderCache:
+    if value_dict is not None:
+        content = tstore.json_dumps_compact(value_dict).encode()
+    else:
+        content = (value_str or '').encode()
+    row = tstore.RenderCache(name=name, value_str=value_str, value_dict=value_dict,
+                             content_hash=hashlib.sha256(content).hexdigest(),
+                             build_timestamp=build_timestamp)
+    if value_str is not None and name in {n.value for n in COMPRESSED_NAMES}:
+        # mtime=0 makes the output depend only on the content. Brotli quality 11 is too slow
+        # for the world geojson.
+        row.value_gzip = gzip.compress(content, mtime=0)
+        row.value_br = brotli.compress(content, quality=9)
+    return row
+
+
+def _make_streamed_cache_row(build_timestamp: datetime.datetime, name: str,
+                             chunks: Iterable[str]) -> tstore.RenderCache:
+    """Returns a row of `name`, one of COMPRESSED_NAMES, with the text of `chunks` hashed and
+    compressed one chunk at a time so the whole text is never in memory. Only the compressed
+    copies are stored; `yield_string` decompresses the gzip copy for clients that want neither."""
+    content_hash = hashlib.sha256()
+    # wbits 31 writes a gzip header with mtime 0, the same as gzip.compress(mtime=0).
+    gzip_compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    br_compressor = brotli.Compressor(quality=9)
+    gzip_parts = []
+    br_parts = []
+    for chunk in chunks:
+        content = chunk.encode()
+        content_hash.update(content)
+        gzip_parts.append(gzip_compressor.compress(content))
+        br_parts.append(br_compressor.process(content))
+    gzip_parts.append(gzip_compressor.flush())
+    br_parts.append(br_compressor.finish())
+    return tstore.RenderCache(name=name, content_hash=content_hash.hexdigest(),
+                              build_timestamp=build_timestamp, value_gzip=b''.join(gzip_parts),
+                              value_br=b''.join(br_parts))
+
+
+@attrs.define()
+class StageStats:
+    name: str
+    seconds: float = 0.0
+    count: int = 0
+    # Peak traced memory while in the stage when tracemalloc is tracing, otherwise the peak
+    # resident size of the process so far.
+    peak_memory_bytes: int = 0
+
+
+@attrs.define()
+class BuildProfile:
+    """Wall time, object counts and peak memory of each stage of `yield_cache`."""
+    stages: Dict[str, StageStats] = attrs.field(factory=dict)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Adds the time spent in the `with` block to stage `name`. Stages must not be nested."""
+        stats = self.stages.setdefault(name, StageStats(name))
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1]
+            else:
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            stats.peak_memory_bytes = max(stats.peak_memory_bytes, peak)
+
+    def format_table(self) -> str:
+        lines = [f'{"stage":<20} {"seconds":>9} {"count":>8} {"peak MiB":>9}']
+        for stats in self.stages.values():
+            lines.append(f'{stats.name:<20} {stats.seconds:>9.3f} {stats.count:>8} '
+                         f'{stats.peak_memory_bytes / 2**20:>9.1f}')
+        total_seconds = sum(stats.seconds for stats in self.stages.values())
+        lines.append(f'{"total":<20} {total_seconds:>9.3f}')
+        return '\n'.join(lines)
+
+
+@attrs.frozen()
+class _PlacePageBuild:
+    """Everything a worker process needs to build place pages. Workers are forked while it is set
+    so they share the loaded snapshot, and start with the same memos, instead of loading or
+    unpickling them. Workers return plain unstructured dicts, not ORM objects."""
+    app: flask.Flask
+    places: List[tstore.Place]
+    source_by_short_name: Mapping[str, render.ClubSource]
+    geometry: GeometryMemo
+    back_links: tstore.ClubBackLinkIndex
+    features: GeojsonFeatures
+    to_html: markdown_html.MarkdownToHtml
+
+
+_place_page_build: Optional[_PlacePageBuild] = None
+
+
+def _init_place_page_worker():
+    _place_page_build.app.app_context().push()
+    # The forked process must not use the database connections of the parent.
+    tstore.db.engine.dispose(close=False)
+
+
+def _build_place_pages(place_indexes: List[int]) -> List[Dict]:
+    build = _place_page_build
+    return [cattrs.unstructure(_build_render_place(
+        build.places[i], build.source_by_short_name, build.geometry, build.back_links,
+        build.features, build.to_html)) for i in place_indexes]
+
+
+def _build_place_pages_in_processes(build: _PlacePageBuild, place_indexes: List[int],
+                                    processes: int) -> Dict[str, Dict]:
+    """Builds the place pages of `build.places` at `place_indexes` in `processes` processes and
+    returns their unstructured values by short_name. The places are split into contiguous
+    partitions, several per process so that a slow partition doesn't leave the others idle, and
+    places near each other in the list often share the map features of their children."""
+    global _place_page_build
+    partition_size = max(1, -(-len(place_indexes) // (processes * 4)))
+    partitions = [place_indexes[i:i + partition_size]
+                  for i in range(0, len(place_indexes), partition_size)]
+    _place_page_build = build
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_place_page_worker) as executor:
+            value_dicts = list(itertools.chain.from_iterable(
+                executor.map(_build_place_pages, partitions)))
+    finally:
+        _place_page_build = None
+    return {build.places[i].short_name: value_dict
+            for i, value_dict in zip(itertools.chain.from_iterable(partitions), value_dicts)}
+
+
+def yield_cache(names: Optional[AbstractSet[str]] = None, profile: Optional[BuildProfile] = None,
+                processes: int = 1):
+    """Yields RenderCache rows. If `names` is set only rows with those names are built. The
+    DEPENDENCIES row is always yielded. The time spent in each stage is added to `profile`.
+
+    With `processes` larger than 1 place pages are built in that many processes. The rows are the
+    same as those built in this process, in the same order."""
+    def wanted(name: str) -> bool:
+        return names is None or name in names
+
+    if profile is None:
+        profile = BuildProfile()
+    build_timestamp = datetime.datetime.utcnow()
+
+    def make_row(name: str, **kwargs) -> tstore.RenderCache:
+        with profile.stage('hash and compress') as stats:
+            stats.count += 1
+            return _make_cache_row(build_timestamp, name=name, **kwargs)
+
+    with profile.stage('load entities') as stats:
+        snapshot = load_snapshot()
+        stats.count = snapshot.entity_count
+    all_places = snapshot.places
+    all_clubs = snapshot.clubs
+    all_pools = snapshot.pools
+    all_comments = snapshot.comments
+    all_sources = snapshot.sources
+
+    with profile.stage('dependencies') as stats:
+        dependencies = _build_dependencies(all_places, all_clubs, all_pools, all_comments,
+                                           all_sources)
+        stats.count = len(dependencies.names_by_entity)
+    yield make_row(RenderName.DEPENDENCIES.value, value_dict=cattrs.unstructure(dependencies))
 
-    all_places: List[tstore.Place] = get_all(tstore.Place)
-    all_clubs: List[tstore.Club] = get_all(tstore.Club)
-    all_pools: List[tstore.Pool] = get_all(tstore.Pool)
-    all_sources: List[tstore.Source] = get_all(tstore.Source)
     source_by_short_name = {s.source_short_name: _build_render_club_source(s) for s in all_sources}
-    version_tables = continuumutils.VersionTables.make()
-    version_tables.populate()
+    geometry = GeometryMemo()
+    with profile.stage('back links') as stats:
+        back_links = tstore.ClubBackLinkIndex.build(all_places)
+        stats.count = len(back_links.clubs_by_parent_and_target)
+    features = GeojsonFeatures(geometry, back_links)
+    pool_name_by_short_name = {p.short_name: p.name for p in all_pools}
+    to_html = markdown_html.MarkdownToHtml(pool_name_by_short_name.get)
+
+    place_page_dicts = {}
+    if processes > 1:
+        # The world page reads recently updated clubs and sources from the session so it is
+        # built in this process.
+        place_indexes = [i for i, p in enumerate(all_places)
+                         if not p.is_world and wanted(place_cache_name(p.short_name))]
+        with profile.stage('place pages') as stats:
+            place_page_dicts = _build_place_pages_in_processes(_PlacePageBuild(
+                flask.current_app._get_current_object(), all_places, source_by_short_name,
+                geometry, back_links, features, to_html), place_indexes, processes)
+            stats.count += len(place_page_dicts)
 
     for place in all_places:
-        render_place = _build_render_place(place, source_by_short_name, version_tables)
-        yield tstore.RenderCache(name=RenderName.PLACE_PREFIX.value + place.short_name,
-                                     value_dict=cattrs.unstructure(render_place))
-        if place.is_world:
-            render_names_world = _build_place_recursive_names(place)
-            yield tstore.RenderCache(name=RenderName.PLACE_NAMES_WORLD.value,
-                                         value_dict=attrs.asdict(
-                                             render_names_world))
-
-    yield tstore.RenderCache(name=RenderName.PROBLEMS.value,
-                             value_dict=cattrs.unstructure(render.Problems(_build_problems(
-                                 all_places, all_clubs))))
-
-    geojson_feature_collection = _build_geojson_feature_collection(all_places, all_pools)
-
-    yield tstore.RenderCache(name=RenderName.POOLS_GEOJSON.value,
-                             value_str=geojson.dumps(geojson_feature_collection))
-
-    be_place = tstore.Place.query.filter_by(short_name='be').first()
-    if be_place:
-        be_geojson_feature_collection = _build_be_geojson_feature_collection(be_place)
-        yield tstore.RenderCache(name=RenderName.BE_GEOJSON.value,
-                                 value_str=geojson.dumps(be_geojson_feature_collection))
-
-    si = io.StringIO()
-    cw = csv.DictWriter(si, extrasaction='ignore',
+        if wanted(place_cache_name(place.short_name)):
+            value_dict = place_page_dicts.get(place.short_name)
+            if value_dict is None:
+                with profile.stage('place pages') as stats:
+                    render_place = _build_render_place(place, source_by_short_name, geometry,
+                                                       back_links, features, to_html)
+                    value_dict = cattrs.unstructure(render_place)
+                    stats.count += 1
+            yield make_row(place_cache_name(place.short_name), value_dict=value_dict)
+        if place.is_world and wanted(RenderName.PLACE_NAMES_WORLD.value):
+            with profile.stage('place names') as stats:
+                value_dict = attrs.asdict(_build_place_recursive_names(place, geometry,
+                                                                       back_links))
+                stats.count += 1
+            yield make_row(RenderName.PLACE_NAMES_WORLD.value, value_dict=value_dict)
+
+    if wanted(RenderName.SHORT_NAMES.value):
+        with profile.stage('short names') as stats:
+            short_names = _build_short_names(all_places, all_clubs, all_pools)
+            value_dict = cattrs.unstructure(short_names)
+            stats.count = len(short_names.targets)
+        yield make_row(RenderName.SHORT_NAMES.value, value_dict=value_dict)
+
+    if wanted(RenderName.PROBLEMS.value):
+        with profile.stage('problems') as stats:
+            problems = _build_problems(all_places, all_clubs, geometry)
+            value_dict = cattrs.unstructure(render.Problems(problems))
+            stats.count = len(problems)
+        yield make_row(RenderName.PROBLEMS.value, value_dict=value_dict)
+
+    if wanted(RenderName.POOLS_GEOJSON.value):
+        with profile.stage('pools geojson') as stats:
+            geojson_feature_collection = _build_geojson_feature_collection(
+                all_places, all_pools, features)
+            value_str = geojson.dumps(geojson_feature_collection)
+            stats.count = len(geojson_feature_collection['features'])
+        yield make_row(RenderName.POOLS_GEOJSON.value, value_str=value_str)
+
+    if wanted(RenderName.BE_GEOJSON.value):
+        with profile.stage('be geojson') as stats:
+            be_place = snapshot.get_place('be')
+            if be_place:
+                be_geojson_feature_collection = _build_be_geojson_feature_collection(be_place,
+                                                                                     geometry)
+                value_str = geojson.dumps(be_geojson_feature_collection)
+                stats.count = len(be_geojson_feature_collection['features'])
+        if be_place:
+            yield make_row(RenderName.BE_GEOJSON.value, value_str=value_str)
+
+    if wanted(RenderName.CSV_ALL.value):
+        with profile.stage('csv') as stats:
+            row = _make_streamed_cache_row(build_timestamp, RenderName.CSV_ALL.value,
+                                           yield_csv(snapshot))
+            stats.count = len(all_places) + len(all_clubs) + len(all_pools)
+        yield row
+
+
+# Lines of CSV are buffered until there are about this many characters to send.
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def _skip_geometry(geom) -> None:
+    # None of the CSV columns is a geometry so there is no need to decode them.
+    return None
+
+
+def yield_csv(snapshot: WorldSnapshot) -> Iterable[str]:
+    """Yields the places, clubs and pools of `snapshot` as CSV, in chunks of about
+    CSV_CHUNK_SIZE so the whole file is never in memory. Entities are sorted by id so the same
+    entities always make the same CSV."""
+    buffer = io.StringIO()
+    cw = csv.DictWriter(buffer, extrasaction='ignore',
                         fieldnames=['type', 'id', 'short_name', 'name', 'parent_short_name',
                                     'markdown', 'status_date', 'status_comment'])
+    def by_id(entities: List[tstore.Entity]) -> List[tstore.Entity]:
+        return sorted(entities, key=lambda e: e.id)
+
+    entities = itertools.chain(
+        (p.as_attrib_entity(_skip_geometry) for p in by_id(snapshot.places)),
+        (c.as_attrib_entity() for c in by_id(snapshot.clubs)),
+        (p.as_attrib_entity(_skip_geometry) for p in by_id(snapshot.pools)))
     cw.writeheader()
-    for place in all_places:
-        cw.writerow(attrs.asdict(place.as_attrib_entity()))
-    for club in all_clubs:
-        if not club.parent:
-            print("odd")
-            pass
-        cw.writerow(attrs.asdict(club.as_attrib_entity()))
-    for pool in all_pools:
-        cw.writerow(attrs.asdict(pool.as_attrib_entity()))
-    yield tstore.RenderCache(name=RenderName.CSV_ALL.value, value_str=si.getvalue())
+    for entity in entities:
+        cw.writerow(attrs.asdict(entity))
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def get_generation() -> int:
+    """Returns the current RenderCacheGeneration or 0 if the cache has never been built."""
+    return render_store.get_store().get_generation()
+
+
+@attrs.define()
+class GenerationCache:
+    """Per-process LRU of objects derived from RenderCache rows, such as structured render objects.
+    It is emptied when the RenderCacheGeneration changes."""
+    maxsize: int
+    generation: Optional[Tuple] = None
+    objects: collections.OrderedDict = attrs.field(factory=collections.OrderedDict)
+    lock: threading.Lock = attrs.field(factory=threading.Lock)
+    # The store `generation` was read from and when, used by `get` with a `generation_max_age`.
+    generation_store: Optional[render_store.RenderStore] = None
+    generation_read_time: float = 0
+
+    def get(self, name: str, load: Callable[[], Any], generation_max_age: float = 0) -> Any:
+        """Returns the object `name`, calling `load` to make it when it isn't in the cache. With a
+        `generation_max_age` the generation is read from the store at most once in that many
+        seconds so most calls don't read the store, but objects may be that old."""
+        store = render_store.get_store()
+        now = time.monotonic()
+        with self.lock:
+            recently_read = (self.generation_store is store and
+                             now - self.generation_read_time < generation_max_age)
+            if recently_read and name in self.objects:
+                self.objects.move_to_end(name)
+                return self.objects[name]
+        generation = store.get_generation_key()
+        with self.lock:
+            self.generation_store = store
+            self.generation_read_time = now
+            if generation != self.generation:
+                self.objects.clear()
+                self.generation = generation
+            elif name in self.objects:
+                self.objects.move_to_end(name)
+                return self.objects[name]
+        obj = load()
+        with self.lock:
+            if generation == self.generation:
+                self.objects[name] = obj
+                if len(self.objects) > self.maxsize:
+                    self.objects.popitem(last=False)
+        return obj
+
+
+def get_generation_cache(name: str, maxsize: int) -> GenerationCache:
+    """Returns the GenerationCache `name` of the current app, creating it with `maxsize` the first
+    time it is used. Keeping caches in the app means objects from another database, such as that
+    of an earlier test, are never returned."""
+    caches = flask.current_app.extensions.setdefault('generation_caches', {})
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches.setdefault(name, GenerationCache(maxsize=maxsize))
+    return cache
+
+
+def _structured_cache() -> GenerationCache:
+    return get_generation_cache('structured', maxsize=500)
+
+
+def _structure_row_or_404(name: str, cl: Type):
+    row = render_store.get_store().get_current(name, tstore.RenderCache.value_dict)
+    if row is None:
+        flask.abort(404)
+    return cattrs.structure(row.value_dict, cl)
 
 
 def get_place(short_name: str) -> render.Place:
-    place_dict = tstore.RenderCache.query.get_or_404(
-        RenderName.PLACE_PREFIX.value + short_name).value_dict
-    return cattrs.structure(place_dict, render.Place)
+    name = place_cache_name(short_name)
+    return _structured_cache().get(name, lambda: _structure_row_or_404(name, render.Place))
 
 
 def get_place_names_world() -> render.PlaceRecursiveNames:
-    names_dict = tstore.RenderCache.query.get(RenderName.PLACE_NAMES_WORLD.value).value_dict
-    return cattrs.structure(names_dict, render.PlaceRecursiveNames)
+    name = RenderName.PLACE_NAMES_WORLD.value
+    return _structured_cache().get(name, lambda: _structure_row_or_404(
+        name, render.PlaceRecursiveNames))
+
+
+@attrs.frozen()
+class RowVersion:
+    content_hash: str
+    build_timestamp: Optional[datetime.datetime]
+
+
+def get_row_version(name: str) -> Optional[RowVersion]:
+    """Returns the hash and build time of a RenderCache row without loading the value, or None if
+    the row doesn't exist or was built before hashes were added."""
+    row = render_store.get_store().get_current(
+        name, tstore.RenderCache.content_hash, tstore.RenderCache.build_timestamp)
+    if row is None or row.content_hash is None:
+        return None
+    return RowVersion(content_hash=row.content_hash, build_timestamp=row.build_timestamp)
 
 
 def get_string(name: RenderName) -> str:
-    return tstore.RenderCache.query.get(name.value).value_str
+    return render_store.get_store().get_current(
+        name.value, tstore.RenderCache.value_str).value_str
+
+
+def yield_string(name: RenderName) -> Iterable[str]:
+    """Returns the value_str of a row as an iterable of chunks. A row made by
+    `_make_streamed_cache_row` has only compressed copies so its gzip copy is decompressed in
+    chunks of about CSV_CHUNK_SIZE bytes as the response is sent. The row is read before this
+    returns so the chunks can be sent after the app context ends."""
+    row = render_store.get_store().get_current(
+        name.value, tstore.RenderCache.value_str, tstore.RenderCache.value_gzip)
+    if row.value_str is not None or row.value_gzip is None:
+        return [row.value_str or '']
+    return _yield_decompressed(row.value_gzip)
+
+
+def _yield_decompressed(value_gzip: bytes) -> Iterable[str]:
+    decompressor = zlib.decompressobj(31)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    data = value_gzip
+    while data:
+        yield decoder.decode(decompressor.decompress(data, CSV_CHUNK_SIZE))
+        data = decompressor.unconsumed_tail
+    yield decoder.decode(decompressor.flush(), final=True)
+
+
+def get_json_text(name: str) -> str:
+    """Returns the value_dict of a RenderCache row as the JSON text that is stored, without decoding
+    it. Aborts with a 404 if there is no row `name`."""
+    value = sqlalchemy.type_coerce(tstore.RenderCache.value_dict, sqlalchemy.String)
+    row = render_store.get_store().get_current(name, value.label('value'))
+    if row is None or row.value is None:
+        flask.abort(404)
+    return row.value
+
+
+def get_json_projection(name: str, fields: AbstractSet[str]) -> str:
+    """Returns the JSON text of a RenderCache value_dict with only the top level keys in `fields`.
+    Each projection is made once per generation and then served from this process."""
+    key = name + '?fields=' + ','.join(sorted(fields))
+
+    def load() -> str:
+        value_dict = json.loads(get_json_text(name))
+        return tstore.json_dumps_compact({k: v for k, v in value_dict.items() if k in fields})
+
+    return get_generation_cache('json_projection', maxsize=200).get(key, load)
+
+
+def get_compressed_string(name: RenderName, encoding: str) -> Optional[bytes]:
+    """Returns the value_str of a row in COMPRESSED_NAMES compressed with `encoding`, one of
+    COMPRESSED_ENCODINGS. Returns None if the row doesn't have a compressed copy."""
+    column = {'br': tstore.RenderCache.value_br,
+              'gzip': tstore.RenderCache.value_gzip}[encoding]
+    row = render_store.get_store().get_current(name.value, column.label('value'))
+    return row.value if row else None
+
+
+@attrs.frozen()
+class GeojsonFeatureIndex:
+    """The features of a stored GeoJSON FeatureCollection in an STRtree, so the features in a
+    bounding box are found without reading or scanning the whole collection."""
+    # Each feature as compact JSON text, in the order of the stored collection.
+    feature_texts: List[str]
+    tree: Optional[STRtree]
+
+    @staticmethod
+    def from_geojson(text: str) -> 'GeojsonFeatureIndex':
+        features = json.loads(text)['features']
+        # Places without a region have an empty feature, which isn't in any box.
+        located = [i for i, f in enumerate(features) if f.get('geometry')]
+        geoms = [shapely_shape(features[i]['geometry']) for i in located]
+        tree = STRtree(geoms, items=located) if geoms else None
+        return GeojsonFeatureIndex(
+            feature_texts=[tstore.json_dumps_compact(f) for f in features], tree=tree)
+
+    def feature_collection_in(self, bbox: render.Bounds) -> str:
+        """Returns a FeatureCollection, as JSON text, of the features intersecting `bbox`. A box
+        with west greater than east crosses the antimeridian."""
+        if bbox.west <= bbox.east:
+            boxes = [shapely_box(bbox.west, bbox.south, bbox.east, bbox.north)]
+        else:
+            boxes = [shapely_box(bbox.west, bbox.south, 180, bbox.north),
+                     shapely_box(-180, bbox.south, bbox.east, bbox.north)]
+        indexes = set()
+        if self.tree is not None:
+            for b in boxes:
+                indexes.update(self.tree.query_items(b))
+        features = ','.join(self.feature_texts[i] for i in sorted(indexes))
+        return '{"type":"FeatureCollection","features":[' + features + ']}'
+
+
+def get_geojson_in_bbox(name: RenderName, bbox: render.Bounds) -> str:
+    """Returns the features of the GeoJSON row `name` that intersect `bbox`. The STRtree is built
+    from the stored row once per generation and then kept in this process."""
+    index = get_generation_cache('geojson_index', maxsize=len(COMPRESSED_NAMES)).get(
+        name.value, lambda: GeojsonFeatureIndex.from_geojson(get_string(name)))
+    return index.feature_collection_in(bbox)
+
+
+def get_short_names() -> render.ShortNames:
+    """Returns the ShortNames index. It is kept in this process and, to redirect old URLs without
+    reading any database, only checked for a new generation every
+    RENDER_CACHE_SHORT_NAMES_MAX_AGE seconds."""
+    name = RenderName.SHORT_NAMES.value
+    return get_generation_cache('short_names', maxsize=1).get(
+        name, lambda: _structure_row_or_404(name, render.ShortNames),
+        generation_max_age=flask.current_app.config['RENDER_CACHE_SHORT_NAMES_MAX_AGE'])
 
 
 def get_problems() -> render.Problems:
-    problems_dict = tstore.RenderCache.query.get_or_404(RenderName.PROBLEMS.value ).value_dict
-    return cattrs.structure(problems_dict, render.Problems)
+    name = RenderName.PROBLEMS.value
+    return _structured_cache().get(name, lambda: _structure_row_or_404(name, render.Problems))
+
+
+# Changes shown on each page of place history
+PLACE_HISTORY_PAGE_SIZE = 50
+
+
+def get_place_history(short_name: str, before: Optional[int] = None,
+                      limit: int = PLACE_HISTORY_PAGE_SIZE) -> render.PlaceHistory:
+    """Returns changes to place `short_name` and its direct children made by transactions before
+    `before`, newest first. History isn't in the RenderCache so each page is read with keyset
+    queries on the indexed transaction ids of the version tables, which only read the versions on
+    the page and the versions they replaced. A page has at least `limit` changes, when there are
+    that many, and never splits the changes of a transaction so `next_before` is a transaction id.
+    """
+    orm_place = tstore.Place.query.filter_by(short_name=short_name).first()
+    if orm_place is None:
+        flask.abort(404)
+    limit = max(limit, 1)
+
+    # Changes made by one transaction are shown in the order of these entities.
+    entities = list(itertools.chain([orm_place], orm_place.child_places, orm_place.child_pools,
+                                    orm_place.child_clubs))
+    entity_order = {entity_key(e): i for i, e in enumerate(entities)}
+    entities_by_key = {entity_key(e): e for e in entities}
+    ids_by_type = defaultdict(list)
+    for entity in entities:
+        ids_by_type[type(entity).__name__.lower()].append(entity.id)
+    tables = {type_name: continuumutils.VersionTable.make(
+        continuumutils.type_to_version_cls[type_name]) for type_name in ids_by_type}
+
+    transaction_ids = sorted(itertools.chain.from_iterable(
+        tables[type_name].load_entity_transaction_ids(ids, before, limit)
+        for type_name, ids in ids_by_type.items()), reverse=True)
+    if not transaction_ids:
+        return render.PlaceHistory(place=render.ChildPlace(orm_place.path, orm_place.name),
+                                   changes=[], next_before=None)
+    # The page ends with the transaction of the `limit`th newest change.
+    last_transaction_id = transaction_ids[min(limit, len(transaction_ids)) - 1]
+
+    # Tuples of (transaction_id, entity order, entity, changeset) for each version on the page
+    candidates = []
+    for type_name, ids in ids_by_type.items():
+        table = tables[type_name]
+        where = [table.version_cls.id.in_(ids),
+                 table.version_cls.transaction_id >= last_transaction_id]
+        if before is not None:
+            where.append(table.version_cls.transaction_id < before)
+        for version, changeset in table.load_changes(*where):
+            key = f'{type_name}/{table.get_value(version, "id")}'
+            candidates.append((version.transaction_id, entity_order[key], entities_by_key[key],
+                               changeset))
+    candidates.sort(key=lambda c: (-c[0], c[1]))
+
+    transactions = continuumutils.load_transactions_by_id({c[0] for c in candidates})
+    changes = []
+    for transaction_id, _, entity, changeset in candidates:
+        issued_at, user_email = transactions[transaction_id]
+        changes.append(render.PlaceHistory.Change(
+            transaction_id=transaction_id,
+            timestamp=issued_at,
+            user=user_email,
+            entity_name=entity.name,
+            change=str(changeset)))
+
+    has_older = any(tables[type_name].load_entity_transaction_ids(ids, last_transaction_id, 1)
+                    for type_name, ids in ids_by_type.items())
+    next_before = last_transaction_id if has_older else None
+    return render.PlaceHistory(place=render.ChildPlace(orm_place.path, orm_place.name),
+                               changes=changes, next_before=next_before)
+
+
+# Transactions shown on each page of the transaction log
+TRANSACTION_LOG_PAGE_SIZE = 50
+
+
+def get_transaction_log(before: Optional[int] = None,
+                        limit: int = TRANSACTION_LOG_PAGE_SIZE) -> render.TransactionLog:
+    """Returns up to `limit` transactions with an id less than `before`, newest first. Each page is
+    read with keyset queries on the indexed transaction ids so it only costs the transactions on
+    it, however long the history is."""
+    page = continuumutils.load_transactions(before, limit + 1)
+    next_before = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_before = page[-1][0]
+
+    transaction_ids = [transaction_id for transaction_id, _, _ in page]
+    changes_by_type = {}
+    for type_name, version_cls in continuumutils.type_to_version_cls.items():
+        table = continuumutils.VersionTable.make(version_cls)
+        changes_by_type[type_name] = {
+            transaction_id: [
+                render.TransactionLog.EntityChange(entity_name=table.get_value(version, 'name'),
+                                                   change=str(changeset))
+                for version, changeset in changes]
+            for transaction_id, changes in table.load_transaction_changes(transaction_ids).items()}
+
+    transactions = []
+    for transaction_id, issued_at, user_email in page:
+        changes = {type_name: by_transaction.get(transaction_id, [])
+                   for type_name, by_transaction in changes_by_type.items()}
+        transactions.append(render.TransactionLog.Transaction(
+            transaction_id=transaction_id, issued_at=issued_at, user=user_email,
+            places=changes['place'], clubs=changes['club'], pools=changes['pool']))
+    return render.TransactionLog(transactions=transactions, next_before=next_before)
@@ -0,0 +1,272 @@
+"""Storage of the RenderCache rows built by render_factory.
+
+By default the rows are in the RenderCache table of tourist.db. When RENDER_CACHE_SQLITE_PATH is
+set they are in a separate SQLite file so that pages are read without using the database file
+and lock shared with edits, logins and continuum versions.
+"""
+import contextlib
+import datetime
+import os
+import threading
+from abc import ABC
+from abc import abstractmethod
+from typing import AbstractSet
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import attrs
+import sqlalchemy
+import sqlalchemy.orm
+from flask import current_app
+from sqlalchemy import event
+
+from tourist.models import tstore
+
+
+# Rows are committed in batches of this size so edits can write between batches.
+WRITE_BATCH_SIZE = 100
+# Generations not activated after this long are from a build that failed part way.
+ABANDONED_GENERATION_AGE = datetime.timedelta(hours=1)
+
+
+def _activated_generations(session):
+    return session.query(tstore.RenderCacheGeneration.generation).filter(
+        tstore.RenderCacheGeneration.activated_timestamp.isnot(None))
+
+
+def _get_generation(session) -> int:
+    return session.query(sqlalchemy.func.max(tstore.RenderCacheGeneration.generation)).filter(
+        tstore.RenderCacheGeneration.activated_timestamp.isnot(None)).scalar() or 0
+
+
+def _get_current_hashes(session) -> Dict[str, Optional[str]]:
+    """Returns the content_hash of the current row of each name not marked deleted."""
+    current_hashes = {}
+    rows = session.query(tstore.RenderCache.name, tstore.RenderCache.content_hash,
+                         tstore.RenderCache.deleted).filter(
+        tstore.RenderCache.generation.in_(_activated_generations(session))).order_by(
+        tstore.RenderCache.generation)
+    # Rows of newer generations replace those of older ones.
+    for name, content_hash, deleted in rows:
+        if deleted:
+            current_hashes.pop(name, None)
+        else:
+            current_hashes[name] = content_hash
+    return current_hashes
+
+
+@attrs.frozen()
+class WriteResult:
+    """What `RenderStore.write_generation` did."""
+    # The new generation, or the current one if nothing was written.
+    generation: int
+    # Rows written, including rows marking a name deleted
+    written_count: int
+    # Rows not written because the current row has the same content_hash
+    skipped_count: int
+
+
+class RenderStore(ABC):
+    """Reads and writes RenderCache rows using the generations described in tstore.RenderCache.
+
+    Subclasses say where the rows are stored by implementing `_reading` and `_writing`.
+    """
+    @abstractmethod
+    def _reading(self) -> contextlib.AbstractContextManager:
+        """Returns a context manager for a session used to read rows."""
+
+    @abstractmethod
+    def _writing(self) -> contextlib.AbstractContextManager:
+        """Returns a context manager for a session used to write rows."""
+
+    def get_current(self, name: str, *columns):
+        """Returns `columns` of the current row named `name` or None if there isn't one."""
+        with self._reading() as session:
+            row = session.query(tstore.RenderCache.deleted, *columns).filter(
+                tstore.RenderCache.name == name,
+                tstore.RenderCache.generation.in_(_activated_generations(session))).order_by(
+                tstore.RenderCache.generation.desc()).first()
+        if row is None or row.deleted:
+            return None
+        return row
+
+    def get_generation(self) -> int:
+        """Returns the current RenderCacheGeneration or 0 if the cache has never been built."""
+        with self._reading() as session:
+            return _get_generation(session)
+
+    def get_generation_key(self) -> Tuple[int, Optional[datetime.datetime]]:
+        """Returns a key that changes whenever a RenderCacheGeneration is activated. Generation
+        numbers are given out when a build starts writing so concurrent builds may be activated
+        out of order, leaving the largest number unchanged. The latest activated_timestamp changes
+        with every activation."""
+        gen = tstore.RenderCacheGeneration
+        with self._reading() as session:
+            latest = session.query(sqlalchemy.func.max(gen.generation),
+                                   sqlalchemy.func.max(gen.activated_timestamp)).filter(
+                gen.activated_timestamp.isnot(None)).one()
+        return (latest[0] or 0, latest[1])
+
+    def write_generation(self, rows: List[tstore.RenderCache],
+                         replaced_names: Optional[AbstractSet[str]]) -> WriteResult:
+        """Writes the changed `rows` in a new RenderCacheGeneration then activates it.
+
+        A row with the same content_hash as the current row of its name is not written and
+        readers keep using the current row. If no row changed no generation is made. Rows are
+        committed in batches of WRITE_BATCH_SIZE and readers keep using the current rows until the
+        last commit sets `activated_timestamp`. Names in `replaced_names` without a new row are
+        marked deleted. If `replaced_names` is None every current name without a new row is marked
+        deleted.
+
+        Once the generation is activated the rows it hides are deleted using the primary key, so
+        the store doesn't grow with each edit when `collect_garbage` isn't run. Other garbage, such
+        as deleted markers and abandoned generations, is left for `collect_garbage`.
+        """
+        with self._writing() as session:
+            current_hashes = _get_current_hashes(session)
+            changed_rows = [row for row in rows if row.content_hash is None or
+                            current_hashes.get(row.name) != row.content_hash]
+            if replaced_names is None:
+                replaced_names = current_hashes.keys()
+            deleted_names = (set(replaced_names) - {row.name for row in rows}) & \
+                current_hashes.keys()
+            skipped_count = len(rows) - len(changed_rows)
+            if not changed_rows and not deleted_names:
+                return WriteResult(generation=_get_generation(session), written_count=0,
+                                   skipped_count=skipped_count)
+
+            new_generation = tstore.RenderCacheGeneration()
+            session.add(new_generation)
+            session.commit()
+            generation = new_generation.generation
+
+            changed_rows = changed_rows + [tstore.RenderCache(name=name, deleted=True)
+                                           for name in sorted(deleted_names)]
+            for i in range(0, len(changed_rows), WRITE_BATCH_SIZE):
+                for row in changed_rows[i:i + WRITE_BATCH_SIZE]:
+                    row.generation = generation
+                    session.add(row)
+                session.commit()
+
+            session.query(tstore.RenderCacheGeneration).filter_by(generation=generation).update(
+                {'activated_timestamp': datetime.datetime.utcnow()})
+            session.commit()
+
+            written_names = sorted(row.name for row in changed_rows)
+            for i in range(0, len(written_names), WRITE_BATCH_SIZE):
+                session.query(tstore.RenderCache).filter(
+                    tstore.RenderCache.name.in_(written_names[i:i + WRITE_BATCH_SIZE]),
+                    tstore.RenderCache.generation < generation).delete(synchronize_session=False)
+                session.commit()
+        return WriteResult(generation=generation, written_count=len(changed_rows),
+                           skipped_count=skipped_count)
+
+    def delete_name(self, name: str):
+        """Deletes every row named `name`, in all generations."""
+        with self._writing() as session:
+            session.query(tstore.RenderCache).filter_by(name=name).delete(
+                synchronize_session=False)
+            session.commit()
+
+    def collect_garbage(self) -> int:
+        """Deletes RenderCache rows that readers no longer use and returns how many were deleted.
+
+        These are rows hidden by a row with the same name in a newer activated generation, deleted
+        markers with nothing left to hide and rows of generations abandoned by a failed build.
+        """
+        rc = tstore.RenderCache
+        rc_newer = sqlalchemy.orm.aliased(tstore.RenderCache)
+        gen = tstore.RenderCacheGeneration
+        with self._writing() as session:
+            activated = _activated_generations(session)
+
+            hidden = session.query(rc_newer.generation).filter(
+                rc_newer.name == rc.name, rc_newer.generation > rc.generation,
+                rc_newer.generation.in_(activated)).exists()
+            deleted_count = session.query(rc).filter(hidden).delete(synchronize_session=False)
+
+            # A deleted marker is kept while a build that started earlier may still write the
+            # same name.
+            earlier_build = session.query(gen.generation).filter(
+                gen.activated_timestamp.is_(None), gen.generation < rc.generation).exists()
+            deleted_count += session.query(rc).filter(
+                rc.deleted, rc.generation.in_(activated), ~earlier_build).delete(
+                synchronize_session=False)
+
+            abandoned = (gen.activated_timestamp.is_(None),
+                         gen.timestamp < datetime.datetime.utcnow() - ABANDONED_GENERATION_AGE)
+            deleted_count += session.query(rc).filter(rc.generation.in_(
+                session.query(gen.generation).filter(*abandoned))).delete(
+                synchronize_session=False)
+            session.query(gen).filter(*abandoned).delete(synchronize_session=False)
+
+            # Keep the current generation, it is the key of GenerationCache.
+            has_rows = session.query(rc.generation).filter(
+                rc.generation == gen.generation).exists()
+            session.query(gen).filter(gen.activated_timestamp.isnot(None), ~has_rows,
+                                      gen.generation < _get_generation(session)).delete(
+                synchronize_session=False)
+            session.commit()
+        return deleted_count
+
+
+class TouristDbRenderStore(RenderStore):
+    """Rows in the RenderCache table of tourist.db, read and written with `tstore.db.session`."""
+    def _reading(self):
+        return contextlib.nullcontext(tstore.db.session)
+
+    def _writing(self):
+        return contextlib.nullcontext(tstore.db.session)
+
+
+class SqliteFileRenderStore(RenderStore):
+    """Rows in a SQLite file of their own. Rows are read with a read-only connection and each
+    read or write uses a new short-lived session so a long running process never holds an old
+    snapshot of the file.
+
+    Processes that only read, such as web processes when the RenderCache is built by `batchtool
+    render-cache`, only open the read-only engine. The write engine is made, and the file and its
+    tables are created, the first time a process writes or reads before the file exists.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.read_engine = sqlalchemy.create_engine(f'sqlite:///file:{path}?mode=ro&uri=true')
+        self._write_engine = None
+        self._write_engine_lock = threading.Lock()
+
+    def _get_write_engine(self) -> sqlalchemy.engine.Engine:
+        with self._write_engine_lock:
+            if self._write_engine is None:
+                write_engine = sqlalchemy.create_engine(f'sqlite:///{self.path}')
+
+                @event.listens_for(write_engine, "connect")
+                def set_wal(dbapi_conn, connection_record):
+                    # Readers don't block, or get blocked by, the writer. The journal mode is
+                    # stored in the file so read-only connections use it too.
+                    dbapi_conn.execute('PRAGMA journal_mode=WAL')
+
+                tstore.db.Model.metadata.create_all(write_engine, tables=[
+                    tstore.RenderCacheGeneration.__table__, tstore.RenderCache.__table__])
+                self._write_engine = write_engine
+        return self._write_engine
+
+    def _reading(self):
+        if not os.path.exists(self.path):
+            # Nothing has been written yet. Create the empty tables so reads find no rows.
+            self._get_write_engine()
+        return sqlalchemy.orm.Session(self.read_engine)
+
+    def _writing(self):
+        return sqlalchemy.orm.Session(self._get_write_engine())
+
+
+def get_store() -> RenderStore:
+    """Returns the RenderStore of the current app, creating it the first time it is used."""
+    store = current_app.extensions.get('render_store')
+    if store is None:
+        path = current_app.config.get('RENDER_CACHE_SQLITE_PATH')
+        store = SqliteFileRenderStore(path) if path else TouristDbRenderStore()
+        current_app.extensions['render_store'] = store
+    return store
@@ -1,22 +1,32 @@
-import collections
 import datetime
+import functools
+import hashlib
+import math
+import os
+import pathlib
 import re
-from typing import List
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import FrozenSet
 from typing import Optional
 
-import attr
+import attrs
 import flask
 import flask_login
-import sqlalchemy_continuum
+import sqlalchemy
+import sqlalchemy.orm
+import werkzeug.http
 import wtforms.validators
 from akismet import Akismet
 from flask import render_template, Blueprint, redirect, url_for
 from flask_admin.contrib.geoa.fields import GeoJSONField
-from sqlalchemy_continuum import transaction_class
 from wtforms.validators import DataRequired
 
 import tourist
 from tourist import render_factory
+from tourist.models import render
 from tourist.models import tstore
 
 tourist_bp = Blueprint('tourist_bp', __name__)
@@ -26,14 +36,105 @@ def mapbox_access_token():
     return flask.current_app.config['MAPBOX_ACCESS_TOKEN']
 
 
+def conditional_response(render_cache_name: str, get_body: Callable[[], Any],
+                         etag_suffix: str = '') -> flask.Response:
+    """Returns a response with the ETag and Last-Modified of a RenderCache row. If the request
+    has a matching If-None-Match or If-Modified-Since the response is a 304 and `get_body` is not
+    called."""
+    version = render_factory.get_row_version(render_cache_name)
+    if version is None:
+        return flask.make_response(get_body())
+    etag = version.content_hash + etag_suffix
+    if werkzeug.http.is_resource_modified(flask.request.environ, etag=etag,
+                                          last_modified=version.build_timestamp):
+        response = flask.make_response(get_body())
+    else:
+        response = flask.Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = version.build_timestamp
+    # Ask browsers to check with the server before using their copy.
+    response.cache_control.no_cache = True
+    return response
+
+
+def render_cache_string_response(name: render_factory.RenderName) -> flask.Response:
+    """Returns a conditional response with the value_str of a RenderCache row. If the client
+    accepts it a compressed copy stored by the render build is sent, so nothing is compressed
+    per request."""
+    encoding = None
+    if name in render_factory.COMPRESSED_NAMES:
+        encoding = flask.request.accept_encodings.best_match(
+            render_factory.COMPRESSED_ENCODINGS)
+    if encoding is None:
+        return conditional_response(name.value, lambda: render_factory.yield_string(name))
+
+    def get_body():
+        nonlocal encoding
+        body = render_factory.get_compressed_string(name, encoding)
+        if body is None:
+            # The row was built before compressed copies were added.
+            encoding = None
+            body = render_factory.yield_string(name)
+        return body
+
+    response = conditional_response(name.value, get_body, etag_suffix=f'-{encoding}')
+    if response.status_code == 200 and encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def get_anonymous_html_cache() -> render_factory.GenerationCache:
+    """Returns the cache of HTML rendered for anonymous visitors of the current app, creating it the
+    first time it is used."""
+    return render_factory.get_generation_cache(
+        'anonymous_html', maxsize=flask.current_app.config['ANONYMOUS_HTML_CACHE_SIZE'])
+
+
+def get_app_version() -> str:
+    """Returns a hash of the Python source and templates of the app, computed once per process, so
+    that HTML rendered by an earlier deploy isn't used."""
+    version = flask.current_app.extensions.get('app_version')
+    if version is None:
+        digest = hashlib.sha256()
+        root = pathlib.Path(flask.current_app.root_path)
+        for path in sorted([*root.glob('**/*.py'), *root.glob('templates/**/*.html')]):
+            digest.update(path.read_bytes())
+        version = digest.hexdigest()[:12]
+        flask.current_app.extensions['app_version'] = version
+    return version
+
+
+def render_template_cached_for_anonymous(render_cache_name: str, template_name: str,
+                                         get_context: Callable[[], Dict[str, Any]]):
+    """Returns the rendered template, reusing HTML rendered for an earlier anonymous request of the
+    same URL until the RenderCacheGeneration changes. The template is always rendered for logged in
+    users, when there are flashed messages to show and for URLs with a query string."""
+    if (flask_login.current_user.is_authenticated or flask.request.args or
+            flask.session.get('_flashes')):
+        return render_template(template_name, **get_context())
+    # Humanized times such as "5 minutes ago" are rendered again in each period of
+    # ANONYMOUS_HTML_CACHE_SECONDS and every page is rendered again after a deploy.
+    time_bucket = int(time.time() // flask.current_app.config['ANONYMOUS_HTML_CACHE_SECONDS'])
+    version = f'{get_app_version()}-{time_bucket}'
+    key = f'{version} {flask.request.url}'
+
+    def get_html() -> bytes:
+        return get_anonymous_html_cache().get(
+            key, lambda: render_template(template_name, **get_context()).encode())
+
+    return conditional_response(render_cache_name, get_html, etag_suffix=f'-{version}')
+
+
 # Render routes
 #
 # These routes read data from render_factory and don't modify stored data.
 
 @tourist_bp.route("/")
 def home_view_func():
-    render_world = render_factory.get_place('world')
-    return render_template("home.html", world=render_world, mapbox_access_token=mapbox_access_token())
+    return render_template_cached_for_anonymous(
+        render_factory.place_cache_name('world'), "home.html", lambda: dict(
+        world=render_factory.get_place('world'), mapbox_access_token=mapbox_access_token()))
 
 
 @tourist_bp.route("/place_map_iframe_be.html")
@@ -45,34 +146,137 @@ def place_map_be():
 def place_short_name(short_name):
     if short_name == 'world':
         return redirect(url_for('.home_view_func'))
-    render_place = render_factory.get_place(short_name)
-    return render_template("place.html", place=render_place,
-                           mapbox_access_token=mapbox_access_token())
+    return render_template_cached_for_anonymous(
+        render_factory.place_cache_name(short_name), "place.html", lambda: dict(
+        place=render_factory.get_place(short_name), mapbox_access_token=mapbox_access_token()))
+
+
+@tourist_bp.route("/place/<string:short_name>/changes")
+def place_changes(short_name):
+    if not flask_login.current_user.edit_granted:
+        return tourist.inaccessible_response()
+
+    before = flask.request.args.get('before', type=int)
+    history = render_factory.get_place_history(short_name, before=before)
+    return render_template("place_changes.html", history=history, short_name=short_name)
+
+
+# The tiles used to widen a bbox are no smaller than those of this zoom level.
+MAX_BBOX_ZOOM = 16
+
+
+def parse_bbox(bbox_arg: str, zoom: Optional[int]) -> render.Bounds:
+    """Parses a `w,s,e,n` bounding box in degrees. With a map `zoom` the box is widened to the
+    edges of the tiles of that zoom level so that small pans of the map request the same box."""
+    try:
+        west, south, east, north = (float(v) for v in bbox_arg.split(','))
+    except ValueError:
+        flask.abort(400, 'bbox must be four numbers: west,south,east,north')
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        flask.abort(400, 'bbox is outside of the world')
+    if zoom is not None:
+        tile_degrees = 360 / 2 ** min(max(zoom, 0), MAX_BBOX_ZOOM)
+        west = max(-180.0, math.floor(west / tile_degrees) * tile_degrees)
+        east = min(180.0, math.ceil(east / tile_degrees) * tile_degrees)
+        south = max(-90.0, math.floor(south / tile_degrees) * tile_degrees)
+        north = min(90.0, math.ceil(north / tile_degrees) * tile_degrees)
+    return render.Bounds(north=north, south=south, west=west, east=east)
 
 
 @tourist_bp.route("/data/pools.geojson")
 def data_all_geojson():
-    return render_factory.get_string(render_factory.RenderName.POOLS_GEOJSON)
+    """Returns every pool and place on the map. With `?bbox=w,s,e,n` only the features in the box
+    are returned and an optional `zoom` widens the box to tile edges."""
+    bbox_arg = flask.request.args.get('bbox')
+    if not bbox_arg:
+        return render_cache_string_response(render_factory.RenderName.POOLS_GEOJSON)
+    bbox = parse_bbox(bbox_arg, flask.request.args.get('zoom', type=int))
+    response = conditional_response(
+        render_factory.RenderName.POOLS_GEOJSON.value,
+        lambda: render_factory.get_geojson_in_bbox(render_factory.RenderName.POOLS_GEOJSON, bbox),
+        etag_suffix=f'-{bbox.west},{bbox.south},{bbox.east},{bbox.north}')
+    response.mimetype = 'application/geo+json'
+    return response
 
 
 @tourist_bp.route("/data/place/be.geojson")
 def data_be_geojson():
-    return render_factory.get_string(render_factory.RenderName.BE_GEOJSON)
+    return render_cache_string_response(render_factory.RenderName.BE_GEOJSON)
+
+
+def render_cache_json_response(render_cache_name: str, cl: type,
+                               private_fields: FrozenSet[str] = frozenset()) -> flask.Response:
+    """Returns a conditional response with the value_dict of a RenderCache row as the JSON text that
+    is stored. With `?fields=a,b` only those top level attributes of `cl` are included.
+    `private_fields`, such as comments with the IP address of the commenter, are only sent to
+    editors."""
+    fields_arg = flask.request.args.get('fields')
+    can_view_private = flask_login.current_user.edit_granted
+    if fields_arg:
+        fields = frozenset(fields_arg.split(','))
+        unknown = fields - attrs.fields_dict(cl).keys()
+        if not can_view_private:
+            unknown |= fields & private_fields
+        if unknown:
+            flask.abort(400, f'Unknown fields: {", ".join(sorted(unknown))}')
+    elif private_fields and not can_view_private:
+        fields = frozenset(attrs.fields_dict(cl).keys()) - private_fields
+    else:
+        fields = None
+    if fields is None:
+        response = conditional_response(
+            render_cache_name, lambda: render_factory.get_json_text(render_cache_name))
+    else:
+        response = conditional_response(
+            render_cache_name,
+            lambda: render_factory.get_json_projection(render_cache_name, fields),
+            etag_suffix='-' + ','.join(sorted(fields)))
+    if private_fields:
+        response.vary.add('Cookie')
+    response.mimetype = 'application/json'
+    return response
+
+
+# Attributes of render.Place only sent to editors, as on the place page.
+PLACE_PRIVATE_FIELDS = frozenset(['comments'])
+
+
+@tourist_bp.route("/api/place/<string:short_name>.json")
+def api_place_json(short_name):
+    return render_cache_json_response(render_factory.place_cache_name(short_name), render.Place,
+                                      private_fields=PLACE_PRIVATE_FIELDS)
+
+
+@tourist_bp.route("/api/world/names.json")
+def api_world_names_json():
+    return render_cache_json_response(render_factory.RenderName.PLACE_NAMES_WORLD.value,
+                                      render.PlaceRecursiveNames)
 
 
 @tourist_bp.route("/csv")
 def csv_dump():
-    csv_str = render_factory.get_string(render_factory.RenderName.CSV_ALL)
-    output = flask.make_response(csv_str)
-    output.headers["Content-Disposition"] = "attachment; filename=export.csv"
+    """Returns every place, club and pool as CSV from the RenderCache. With
+    `?place=<short_name>` only that place and its descendants are loaded and streamed."""
+    place_short_name = flask.request.args.get('place')
+    if not place_short_name:
+        output = render_cache_string_response(render_factory.RenderName.CSV_ALL)
+        output.headers["Content-Disposition"] = "attachment; filename=export.csv"
+        output.headers["Content-type"] = "text/csv"
+        return output
+    snapshot = render_factory.load_subtree_snapshot(place_short_name)
+    if snapshot is None:
+        flask.abort(404)
+    output = flask.Response(flask.stream_with_context(render_factory.yield_csv(snapshot)))
+    output.headers["Content-Disposition"] = f"attachment; filename=export-{place_short_name}.csv"
     output.headers["Content-type"] = "text/csv"
     return output
 
 
 @tourist_bp.route("/list")
 def list_view_func():
-    render_world = render_factory.get_place_names_world()
-    return render_template("list.html", world=render_world)
+    return render_template_cached_for_anonymous(
+        render_factory.RenderName.PLACE_NAMES_WORLD.value, "list.html", lambda: dict(
+        world=render_factory.get_place_names_world()))
 
 
 @tourist_bp.route("/problems")
@@ -292,65 +496,99 @@ def delete_pool(pool_id):
 # be nice to retire the links and this code.
 @tourist_bp.route("/page/<string:short_name>")
 def page_short_name(short_name):
-    pool = tstore.Pool.query.filter_by(short_name=short_name).one_or_none()
-    if pool:
-        return redirect(pool.path)
-    club = tstore.Club.query.filter_by(short_name=short_name).one_or_none()
-    if club:
-        return redirect(club.path)
-    place = tstore.Place.query.filter_by(short_name=short_name).one_or_none()
-    if place:
-        return redirect(place.path)
-    flask.abort(404)
+    target = render_factory.get_short_names().get(short_name)
+    if target is None:
+        flask.abort(404)
+    return redirect(target.path)
+
+
+@functools.lru_cache()
+def _old_static_html_short_names(directory: str) -> FrozenSet[str]:
+    return frozenset(name[:-len('.html')] for name in os.listdir(directory)
+                     if name.endswith('.html'))
 
 
 @tourist_bp.route("/<string:short_name>.html")
 def old_place_html_file(short_name):
-    place = tstore.Place.query.filter_by(short_name=short_name).one_or_none()
-    if place is not None:
-        return redirect(url_for('.place_short_name', short_name=place.short_name))
-    # Default to trying to send a few old static files
+    if render_factory.get_short_names().get(short_name, 'place') is not None:
+        return redirect(url_for('.place_short_name', short_name=short_name))
+    # Default to trying to send a few old static files. The names of the files are kept so that
+    # requests for other names don't touch the filesystem.
+    directory = os.path.join(flask.current_app.root_path, 'static/pucku')
+    if short_name not in _old_static_html_short_names(directory):
+        flask.abort(404)
     return flask.send_from_directory('static/pucku', f'{short_name}.html')
 
 
-Transaction = transaction_class(tstore.Club)
-ClubVersion = sqlalchemy_continuum.version_class(tstore.Club)
-PlaceVersion = sqlalchemy_continuum.version_class(tstore.Place)
-PoolVersion = sqlalchemy_continuum.version_class(tstore.Pool)
-
-
-@attr.s(auto_attribs=True, slots=True)
-class TransactionLog:
-    issued_at: Optional[datetime.datetime]
-    clubs: List[ClubVersion] = attr.ib(factory=list)
-    pools: List[PoolVersion] = attr.ib(factory=list)
-    places: List[PlaceVersion] = attr.ib(factory=list)
+# Most transactions shown on one page of the transaction log
+TRANSACTION_LOG_MAX_LIMIT = 500
 
 
 @tourist_bp.route("/transactionlog")
 def log_view_func():
-    manager = tstore.Club.__versioning_manager__
-    tx_column = manager.option(tstore.Club, 'transaction_column_name')
-    transaction_logs = collections.defaultdict(TransactionLog)
-    for t in Transaction.query.all():
-        transaction_logs[t.id] = TransactionLog(issued_at=t.issued_at)
-
-    for club_version in ClubVersion.query.all():
-        transaction_logs[getattr(club_version, tx_column)].clubs.append(club_version)
-
-    for place_version in PlaceVersion.query.all():
-        transaction_logs[getattr(place_version, tx_column)].places.append(place_version)
+    before = flask.request.args.get('before', type=int)
+    limit = flask.request.args.get('limit', default=render_factory.TRANSACTION_LOG_PAGE_SIZE,
+                                   type=int)
+    limit = max(1, min(limit, TRANSACTION_LOG_MAX_LIMIT))
+    log = render_factory.get_transaction_log(before=before, limit=limit)
+    return render_template("transaction_log.html", log=log, limit=limit)
 
-    for pool_version in PoolVersion.query.all():
-        transaction_logs[getattr(pool_version, tx_column)].pools.append(pool_version)
 
-    return render_template("transaction_log.html", transactions=transaction_logs.values())
+# Comments shown on each page of /comments
+COMMENTS_PAGE_SIZE = 50
+# PlaceComment.akismet_spam_status values, from python-akismet SpamStatus
+SPAM_STATUS_LABELS = {None: 'Not checked', 0: 'Not spam', 1: 'Unknown', 2: 'Probable spam',
+                      3: 'Definite spam'}
 
 
 @tourist_bp.route("/comments")
 def comments_view_func():
+    """Lists comments, newest first, one page at a time. `before` is the '<timestamp>,<id>' of the
+    last comment on the previous page, with an empty timestamp for a comment without one. Comments
+    without a timestamp are listed after all others. `spam_status` ('none' for not checked) and
+    `place_id` filter the comments."""
     if not flask_login.current_user.can_view_comments:
         return tourist.inaccessible_response()
 
-    comments = list(tstore.PlaceComment.query.order_by(tstore.PlaceComment.timestamp).all())
-    return render_template("comments.html", comments=comments)
+    comment = tstore.PlaceComment
+    filters = []
+    place_id = flask.request.args.get('place_id', type=int)
+    if place_id is not None:
+        filters.append(comment.place_id == place_id)
+    spam_status_counts = dict(tstore.db.session.query(
+        comment.akismet_spam_status, sqlalchemy.func.count(comment.id)).filter(*filters).group_by(
+        comment.akismet_spam_status))
+
+    spam_status = flask.request.args.get('spam_status')
+    before = flask.request.args.get('before')
+    try:
+        if spam_status == 'none':
+            filters.append(comment.akismet_spam_status.is_(None))
+        elif spam_status is not None:
+            filters.append(comment.akismet_spam_status == int(spam_status))
+        if before:
+            before_timestamp, before_id = before.rsplit(',', 1)
+            before_id = int(before_id)
+            if before_timestamp:
+                filters.append(sqlalchemy.or_(
+                    sqlalchemy.tuple_(comment.timestamp, comment.id) <
+                    (datetime.datetime.fromisoformat(before_timestamp), before_id),
+                    comment.timestamp.is_(None)))
+            else:
+                filters.append(sqlalchemy.and_(comment.timestamp.is_(None),
+                                               comment.id < before_id))
+    except ValueError:
+        flask.abort(400)
+
+    comments = comment.query.options(sqlalchemy.orm.joinedload(comment.place)).filter(
+        *filters).order_by(comment.timestamp.desc().nulls_last(), comment.id.desc()).limit(
+        COMMENTS_PAGE_SIZE + 1).all()
+    next_before = None
+    if len(comments) > COMMENTS_PAGE_SIZE:
+        comments = comments[:COMMENTS_PAGE_SIZE]
+        last = comments[-1]
+        next_before = f'{last.timestamp.isoformat() if last.timestamp else ""},{last.id}'
+    return render_template("comments.html", comments=comments, next_before=next_before,
+                           spam_status=spam_status, place_id=place_id,
+                           spam_status_counts=spam_status_counts,
+                           spam_status_labels=SPAM_STATUS_LABELS)
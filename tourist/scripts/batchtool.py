@@ -1,6 +1,9 @@
+import cProfile
 import datetime
 import operator
 import re
+import time
+import tracemalloc
 from collections import defaultdict
 from typing import Dict
 from typing import Iterable
@@ -21,6 +24,7 @@ from more_itertools import last
 
 import tourist
 from tourist import render_factory
+from tourist import render_store
 from tourist.continuumutils import ClubVersion
 from tourist.continuumutils import PlaceVersion
 from tourist.continuumutils import PoolVersion
@@ -137,9 +141,73 @@ def validate():
 
 
 @batchtool_cli.command('render-cache')
-def render_cache():
-    with tstore.db.session.begin():
-        tstore.db.session.add_all(render_factory.yield_cache())
+@click.option('--worker', is_flag=True,
+              help='Keep running, rebuilding the render cache after edits are committed. Use '
+                   'with config RENDER_CACHE_BACKGROUND.')
+@click.option('--poll-seconds', default=2.0)
+@click.option('--profile', is_flag=True,
+              help='Rebuild every row then print the time, count and peak memory of each stage.')
+@click.option('--cprofile-output', type=click.Path(dir_okay=False),
+              help='With --profile, also write cProfile stats of the rebuild to this file.')
+@click.option('--processes', default=1, type=click.IntRange(min=1),
+              help='Build the place pages of the complete rebuild in this many processes. Not '
+                   'used with --worker, which rebuilds the rows changed by each edit.')
+def render_cache(worker: bool, poll_seconds: float, profile: bool, cprofile_output: Optional[str],
+                 processes: int):
+    if worker and processes > 1:
+        raise click.UsageError('--processes is only used by a complete rebuild, not with --worker.')
+    if worker and profile:
+        raise click.UsageError('--profile is only used by a complete rebuild, not with --worker.')
+    if cprofile_output and not profile:
+        raise click.UsageError('--cprofile-output is only used with --profile.')
+    if profile:
+        # tracemalloc makes the rebuild slower but gives the peak memory of each stage.
+        tracemalloc.start()
+        build_profile = render_factory.BuildProfile()
+        profiler = cProfile.Profile()
+        if cprofile_output:
+            profiler.enable()
+        result = tourist.rebuild_render_cache(tstore.db.session, None, build_profile, processes)
+        if cprofile_output:
+            profiler.disable()
+            profiler.dump_stats(cprofile_output)
+        tracemalloc.stop()
+        render_store.get_store().collect_garbage()
+        click.echo(build_profile.format_table())
+        if result:
+            click.echo(f'Wrote {result.written_count} rows, skipped {result.skipped_count} '
+                       f'unchanged rows')
+        return
+    if not worker:
+        tourist.rebuild_render_cache(tstore.db.session, None, processes=processes)
+        render_store.get_store().collect_garbage()
+        return
+    click.echo('Waiting for render cache updates')
+    collected = True
+    while True:
+        try:
+            if tourist.process_render_cache_updates(tstore.db.session):
+                collected = False
+                continue
+            if not collected:
+                # Old generations are removed once there are no more updates waiting.
+                render_store.get_store().collect_garbage()
+                collected = True
+                continue
+        except Exception:
+            # Such as 'database is locked' while an edit is written. The markers are only deleted
+            # after a rebuild so the update is tried again.
+            flask.current_app.logger.exception('Render cache update failed, will try again')
+            tstore.db.session.rollback()
+        time.sleep(poll_seconds)
+
+
+@batchtool_cli.command('render-cache-gc')
+def render_cache_gc():
+    """Delete render cache rows that are no longer read. Run this periodically when
+    RENDER_CACHE_BACKGROUND isn't set, as edits don't collect garbage."""
+    deleted_count = render_store.get_store().collect_garbage()
+    click.echo(f'Deleted {deleted_count} rows')
 
 
 @batchtool_cli.command('transactionshift')
@@ -1,9 +1,13 @@
 import datetime
+import gzip
 import logging
+import re
 from pprint import pprint
 
+import brotli
 import flask
 import pytest
+import sqlalchemy
 from geoalchemy2 import WKTElement
 from more_itertools import one
 from pytest import approx
@@ -11,6 +15,8 @@ from pytest_mock import MockerFixture
 from testfixtures import LogCapture
 
 import tourist.models.render
+import tourist.routes
+from tourist import continuumutils
 from tourist import render_factory
 from tourist.scripts.sync import StaticSyncer
 from tourist.tests.conftest import no_expire_on_commit
@@ -251,6 +257,167 @@ def test_club_without_status_date(test_app):
         assert 'Add a status_date as a valid YYYY-MM-DD to Foo' in response.get_data(as_text=True)
 
 
+def test_anonymous_html_cache(test_app, monkeypatch):
+    add_some_entities(test_app)
+    edit_user = add_and_return_edit_granted_user(test_app)
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/place/metro')
+        assert 'Metro Name' in response.get_data(as_text=True)
+        assert 'Edit place' not in response.get_data(as_text=True)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('page rendered again for an anonymous visitor')
+
+    # The second anonymous request is served without structuring the place or rendering it.
+    with monkeypatch.context() as m:
+        m.setattr(tourist.routes, 'render_template', fail)
+        m.setattr(render_factory, 'get_place', fail)
+        with test_app.test_client() as c:
+            cached = c.get('/tourist/place/metro')
+            assert cached.get_data() == response.get_data()
+
+    with test_app.test_client(user=edit_user) as c:
+        response = c.get('/tourist/place/metro')
+        assert 'Edit place' in response.get_data(as_text=True)
+
+    with test_app.app_context():
+        metro = tstore.Place.query.filter_by(short_name='metro').one()
+        metro.name = 'Metro Renamed'
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/place/metro')
+        assert 'Metro Renamed' in response.get_data(as_text=True)
+        assert 'Edit place' not in response.get_data(as_text=True)
+
+        # Humanized times are rendered again in the next period and after a deploy.
+        etag = response.headers['ETag']
+        later = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=test_app.config['ANONYMOUS_HTML_CACHE_SECONDS'])
+        with freeze_time(later):
+            assert c.get('/tourist/place/metro').headers['ETag'] != etag
+        test_app.extensions['app_version'] = 'next-deploy'
+        assert c.get('/tourist/place/metro').headers['ETag'] != etag
+
+
+def test_conditional_get(test_app):
+    add_some_entities(test_app)
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/data/pools.geojson')
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        response = c.get('/tourist/data/pools.geojson', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.get_data() == b''
+
+        response = c.get('/tourist/place/metro')
+        assert response.status_code == 200
+        response = c.get('/tourist/place/metro',
+                         headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+    with test_app.app_context():
+        pool = tstore.Pool.query.filter_by(short_name='poolish').one()
+        pool.entrance = WKTElement('POINT(150.88 -34.41)', srid=4326)
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/data/pools.geojson', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+
+def test_compressed_geojson(test_app):
+    add_some_entities(test_app)
+
+    with test_app.test_client() as c:
+        plain = c.get('/tourist/data/pools.geojson')
+        assert 'Content-Encoding' not in plain.headers
+
+        response = c.get('/tourist/data/pools.geojson', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()) == plain.get_data()
+        assert response.headers['ETag'] != plain.headers['ETag']
+
+        response = c.get('/tourist/data/pools.geojson', headers={'Accept-Encoding': 'gzip, br'})
+        assert response.headers['Content-Encoding'] == 'br'
+        assert brotli.decompress(response.get_data()) == plain.get_data()
+
+
+def test_pools_geojson_bbox(test_app):
+    add_some_entities(test_app)
+
+    with test_app.test_client() as c:
+        all_features = c.get('/tourist/data/pools.geojson').json['features']
+        assert all_features
+
+        response = c.get('/tourist/data/pools.geojson?bbox=150.8,-34.5,151.0,-34.3')
+        assert response.status_code == 200
+        assert response.json['features'] == [f for f in all_features if f]
+        response = c.get('/tourist/data/pools.geojson?bbox=150.8,-34.5,151.0,-34.3',
+                         headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+        response = c.get('/tourist/data/pools.geojson?bbox=10,10,20,20')
+        assert response.json == {'type': 'FeatureCollection', 'features': []}
+        # Widened to the zoom 0 tile, which is the whole world.
+        response = c.get('/tourist/data/pools.geojson?bbox=10,10,20,20&zoom=0')
+        assert response.json['features'] == [f for f in all_features if f]
+
+        assert c.get('/tourist/data/pools.geojson?bbox=1,2,3').status_code == 400
+        assert c.get('/tourist/data/pools.geojson?bbox=0,50,1,40').status_code == 400
+
+
+def test_json_api(test_app):
+    add_some_entities(test_app)
+    edit_user = add_and_return_edit_granted_user(test_app)
+
+    with test_app.app_context():
+        tstore.db.session.add(tstore.PlaceComment(
+            source='Web visitor at 10.1.2.3', content='Secret comment', place_id=3,
+            timestamp=datetime.datetime(2023, 1, 1)))
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+        stored = render_factory.render_store.get_store().get_current(
+            render_factory.place_cache_name('metro'), tstore.RenderCache.value_dict)
+        stored_text = tstore.json_dumps_compact(stored.value_dict)
+        assert stored.value_dict['comments']
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/api/place/metro.json')
+        assert response.status_code == 200
+        assert response.mimetype == 'application/json'
+        assert 'comments' not in response.json
+        assert response.json['name'] == 'Metro Name'
+        assert '10.1.2.3' not in response.get_data(as_text=True)
+        assert 'Secret comment' not in response.get_data(as_text=True)
+        response = c.get('/tourist/api/place/metro.json',
+                         headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+        assert c.get('/tourist/api/place/metro.json?fields=name,comments').status_code == 400
+
+        response = c.get('/tourist/api/place/metro.json?fields=name,short_name')
+        assert response.status_code == 200
+        assert response.json == {'name': 'Metro Name', 'short_name': 'metro'}
+        assert c.get('/tourist/api/place/metro.json?fields=name,bogus').status_code == 400
+        assert c.get('/tourist/api/place/nowhere.json').status_code == 404
+
+        response = c.get('/tourist/api/world/names.json?fields=name')
+        assert response.json == {'name': 'World'}
+
+    with test_app.test_client(user=edit_user) as c:
+        # Editors get the stored text, including comments.
+        response = c.get('/tourist/api/place/metro.json')
+        assert response.get_data(as_text=True) == stored_text
+        response = c.get('/tourist/api/place/metro.json?fields=comments')
+        assert response.json['comments'][0]['content'] == 'Secret comment'
+
+
 def test_list(test_app):
     add_some_entities(test_app)
 
@@ -310,6 +477,167 @@ def test_update_render_cache_after_deleting_place_with_pool(test_app):
         l.check(('tourist', 'ERROR', 'Exception in render factory. Update of rendered site DISABLED.'))
 
 
+def test_place_changes(test_app, monkeypatch):
+    add_some_entities(test_app)
+    user = add_and_return_edit_granted_user(test_app)
+    # Pages are read with SQL, without loading the whole history into VersionTables.
+    monkeypatch.setattr(continuumutils, 'get_version_tables', None)
+
+    with test_app.app_context():
+        metro = tstore.Place.query.filter_by(short_name='metro').one()
+        metro.markdown = 'First edit'
+        tstore.db.session.commit()
+        metro.markdown = 'Second edit'
+        tstore.db.session.commit()
+
+        history = render_factory.get_place_history('metro', limit=1)
+        assert [c.change for c in history.changes] == [
+            str({'markdown': ['First edit', 'Second edit']})]
+        history = render_factory.get_place_history('metro', before=history.next_before, limit=1)
+        assert [c.entity_name for c in history.changes] == ['Metro Name']
+        # The changes of the first transaction are not split across pages.
+        history = render_factory.get_place_history('metro', before=history.next_before, limit=1)
+        assert [c.entity_name for c in history.changes] == ['Metro Name', 'Metro Pool',
+                                                            'Foo Club']
+        assert history.next_before is None
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/place/metro/changes')
+        assert response.status_code == 302  # Without login
+
+    with test_app.test_client(user=user) as c:
+        response = c.get('/tourist/place/metro/changes')
+        assert response.status_code == 200
+        assert 'Second edit' in response.get_data(as_text=True)
+        assert 'Older changes' not in response.get_data(as_text=True)
+
+        response = c.get('/tourist/place/metro')
+        assert '/tourist/place/metro/changes' in response.get_data(as_text=True)
+
+
+def test_transaction_log(test_app, monkeypatch):
+    add_some_entities(test_app)
+    # Pages are read with SQL, without loading the whole history into VersionTables.
+    monkeypatch.setattr(continuumutils, 'get_version_tables', None)
+
+    with test_app.app_context():
+        metro = tstore.Place.query.filter_by(short_name='metro').one()
+        metro.markdown = 'First edit'
+        tstore.db.session.commit()
+        metro.markdown = 'Second edit'
+        tstore.db.session.commit()
+
+        log = render_factory.get_transaction_log(limit=2)
+        assert [t.places[0].change for t in log.transactions] == [
+            str({'markdown': ['First edit', 'Second edit']}),
+            str({'markdown': ['', 'First edit']})]
+        log = render_factory.get_transaction_log(before=log.next_before, limit=2)
+        assert [c.entity_name for c in log.transactions[0].clubs] == ['Foo Club']
+        assert [c.entity_name for c in log.transactions[0].pools] == ['Metro Pool']
+        assert log.next_before is None
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/transactionlog?limit=1')
+        assert response.status_code == 200
+        body = response.get_data(as_text=True)
+        assert 'Second edit' in body and 'First edit' in body
+        assert 'limit=1' in body and 'before=' in body
+
+
+def test_comments_pages(test_app, monkeypatch):
+    add_some_entities(test_app)
+    user = add_and_return_edit_granted_user(test_app)
+    monkeypatch.setattr('tourist.routes.COMMENTS_PAGE_SIZE', 2)
+
+    with test_app.app_context():
+        tstore.db.session.add_all([
+            tstore.PlaceComment(source='test', content=f'Comment {i}', place_id=3,
+                                timestamp=datetime.datetime(2023, 1, 1 + i),
+                                akismet_spam_status=status)
+            for i, status in enumerate([0, 2, None])])
+        tstore.db.session.commit()
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/comments')
+        assert response.status_code == 302  # Without login
+
+    with test_app.test_client(user=user) as c:
+        response = c.get('/tourist/comments')
+        body = ' '.join(response.get_data(as_text=True).split())
+        assert 'All (3)' in body and 'Probable spam (1)' in body
+        assert 'Comment 2' in body and 'Comment 1' in body and 'Comment 0' not in body
+        assert 'Older comments' in body
+
+        response = c.get('/tourist/comments?before=2023-01-02T00:00:00,2')
+        body = response.get_data(as_text=True)
+        assert 'Comment 0' in body and 'Comment 1' not in body
+        assert 'Older comments' not in body
+
+        body = c.get('/tourist/comments?spam_status=none').get_data(as_text=True)
+        assert 'Comment 2' in body and 'Comment 1' not in body
+        body = c.get('/tourist/comments?spam_status=2&place_id=3').get_data(as_text=True)
+        assert 'Comment 1' in body and 'Comment 2' not in body
+
+        assert c.get('/tourist/comments?before=yesterday').status_code == 400
+
+    # Comments without a timestamp are on the last pages and can be paged through.
+    with test_app.app_context():
+        tstore.db.session.add_all([
+            tstore.PlaceComment(source='test', content=f'Undated {i}', place_id=3, timestamp=None)
+            for i in range(3)])
+        tstore.db.session.commit()
+
+    with test_app.test_client(user=user) as c:
+        seen = []
+        url = '/tourist/comments'
+        while url:
+            response = c.get(url)
+            assert response.status_code == 200
+            body = response.get_data(as_text=True)
+            seen.extend(re.findall(r'(?:Comment|Undated) \d', body))
+            before = re.search(r'before=([^"&]*)', body)
+            url = f'/tourist/comments?before={before.group(1)}' if before else None
+        assert seen == ['Comment 2', 'Comment 1', 'Comment 0', 'Undated 2', 'Undated 1',
+                        'Undated 0']
+
+
+def test_csv(test_app, monkeypatch):
+    add_some_entities(test_app)
+
+    with test_app.test_client() as c:
+        response = c.get('/tourist/csv')
+        assert response.status_code == 200
+        lines = response.get_data(as_text=True).splitlines()
+        assert lines[0] == ('type,id,short_name,name,parent_short_name,markdown,status_date,'
+                            'status_comment')
+        assert len(lines) == 6
+        # The whole export is a RenderCache row with validators and compressed copies.
+        assert c.get('/tourist/csv', headers={'If-None-Match': response.headers['ETag']}
+                     ).status_code == 304
+        compressed = c.get('/tourist/csv', headers={'Accept-Encoding': 'gzip'})
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(compressed.get_data()) == response.get_data()
+
+        response = c.get('/tourist/csv?place=metro')
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert 'export-metro.csv' in response.headers['Content-Disposition']
+        body = response.get_data(as_text=True)
+        assert 'Metro Name' in body and 'Foo Club' in body and 'Metro Pool' in body
+        assert 'Country Name' not in body
+
+        response = c.get('/tourist/csv?place=nowhere')
+        assert response.status_code == 404
+
+    with test_app.app_context():
+        snapshot = render_factory.load_snapshot()
+        whole = ''.join(render_factory.yield_csv(snapshot))
+        monkeypatch.setattr(render_factory, 'CSV_CHUNK_SIZE', 10)
+        chunks = list(render_factory.yield_csv(snapshot))
+        assert len(chunks) > 6
+        assert ''.join(chunks) == whole
+
+
 def test_delete_club(test_app):
     add_some_entities(test_app)
     user = add_and_return_edit_granted_user(test_app)
@@ -462,6 +790,30 @@ def test_page_not_found(test_app):
         assert response.status_code == 404
 
 
+def test_old_page_redirects(test_app):
+    add_some_entities(test_app)
+    test_app.config['RENDER_CACHE_SHORT_NAMES_MAX_AGE'] = 60
+
+    with test_app.test_client() as c:
+        assert c.get('/tourist/page/shortie').location.endswith('/tourist/place/metro#shortie')
+        assert c.get('/tourist/page/poolish').location.endswith('/tourist/place/metro')
+        assert c.get('/tourist/page/cc').location.endswith('/tourist/place/cc')
+        assert c.get('/tourist/cc.html').location.endswith('/tourist/place/cc')
+        assert c.get('/tourist/index.html').status_code == 200
+
+        # Once the index is loaded names are resolved without reading any database.
+        statements = []
+        with test_app.app_context():
+            sqlalchemy.event.listen(tstore.db.engine, 'before_cursor_execute',
+                                    lambda conn, cursor, statement, *args:
+                                    statements.append(statement))
+        assert c.get('/tourist/page/metro').location.endswith('/tourist/place/metro')
+        assert c.get('/tourist/page/notfound').status_code == 404
+        assert c.get('/tourist/shortie.html').status_code == 404
+        assert c.get('/tourist/notfound.html').status_code == 404
+        assert statements == []
+
+
 def test_place_not_found(test_app):
     with test_app.test_client() as c:
         response = c.get('/tourist/place/notfound')
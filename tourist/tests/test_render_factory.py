@@ -1,9 +1,15 @@
+import datetime
+
 import geojson
+import sqlalchemy
 from geoalchemy2 import WKTElement
 
 import tourist
+from tourist import continuumutils
 from tourist import render_factory
+from tourist import render_store
 from tourist.models import tstore
+from tourist.scripts import batchtool
 
 
 polygon1 = WKTElement('POLYGON((150.90 -34.42,150.90 -34.39,150.86 -34.39,150.86 -34.42,'
@@ -78,3 +84,510 @@ def test_be_geojson(test_app):
     titles = set(f['properties']['title'] for f in collection['features'])
     assert titles == {'Our Club'}
 
+
+
+def test_incremental_update(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        metro_a = tstore.Place(name='Metro A', short_name='metro_a', parent=country,
+                               region=polygon1, markdown='')
+        metro_b = tstore.Place(name='Metro B', short_name='metro_b', parent=country,
+                               region=polygon1, markdown='')
+        pool = tstore.Pool(name='Pool A', short_name='poola', parent=metro_a, markdown='',
+                           entrance=point1)
+        club = tstore.Club(name='Club A', short_name='cluba', parent=metro_a,
+                           markdown='plays at [[poola]]')
+        tstore.db.session.add_all([world, country, metro_a, metro_b, pool, club])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.app_context():
+        club = tstore.Club.query.filter_by(short_name='cluba').one()
+        club.name = 'Club A Renamed'
+        tstore.db.session.commit()
+        affected = render_factory.get_affected_names({render_factory.entity_key(club)})
+        assert {'/place/metro_a', '/place/cc', '/place/world', '/pools.geojson'} <= affected
+        assert '/place/metro_b' not in affected
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.app_context():
+        assert render_factory.get_place('metro_a').child_clubs[0].name == 'Club A Renamed'
+
+        # Moving the club rebuilds the pages of the old and new place.
+        club = tstore.Club.query.filter_by(short_name='cluba').one()
+        club.parent = tstore.Place.query.filter_by(short_name='metro_b').one()
+        tstore.db.session.commit()
+        affected = render_factory.get_affected_names({render_factory.entity_key(club)})
+        assert {'/place/metro_a', '/place/metro_b'} <= affected
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.app_context():
+        assert render_factory.get_place('metro_a').child_clubs == []
+        assert render_factory.get_place('metro_b').child_clubs[0].name == 'Club A Renamed'
+
+
+def test_comment_does_not_rebuild_place_subtree(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        other_country = tstore.Place(name='Other Country', short_name='oc', parent=world,
+                                     region=polygon1, markdown='')
+        metro = tstore.Place(name='Metro A', short_name='metro_a', parent=country,
+                             region=polygon1, markdown='')
+        tstore.db.session.add_all([world, country, other_country, metro])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.app_context():
+        country = tstore.Place.query.filter_by(short_name='cc').one()
+        comment = tstore.PlaceComment(place=country, source='test', content='Hello',
+                                      timestamp=datetime.datetime(2023, 1, 1))
+        tstore.db.session.add(comment)
+        tstore.db.session.commit()
+        # Place.comments of the country changed but the country itself didn't.
+        changed = tstore.db.session.info[tourist.UPDATE_RENDER_AFTER_FLUSH]
+        assert changed == {render_factory.entity_key(comment)}
+        affected = render_factory.get_affected_names(changed)
+        assert '/place/cc' in affected
+        assert not {'/place/metro_a', '/place/oc', '/pools.geojson'} & affected
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.app_context():
+        assert render_factory.get_place('cc').comments[0].content == 'Hello'
+
+
+def test_background_update(test_app):
+    test_app.config['RENDER_CACHE_BACKGROUND'] = True
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        tstore.db.session.add_all([world, country])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+        country.name = 'Country Renamed'
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+        assert tstore.RenderCacheDirty.query.count() == 2
+        assert render_factory.get_row_version('/place/cc') is None
+
+        # Both markers are handled by one rebuild.
+        assert tourist.process_render_cache_updates(tstore.db.session)
+        assert tstore.RenderCacheDirty.query.count() == 0
+        assert tstore.RenderCacheGeneration.query.count() == 1
+        assert render_factory.get_place('cc').name == 'Country Renamed'
+
+        assert not tourist.process_render_cache_updates(tstore.db.session)
+        assert tstore.RenderCacheGeneration.query.count() == 1
+
+
+class _StopWorker(Exception):
+    pass
+
+
+def test_background_worker_continues_after_error(test_app, monkeypatch):
+    test_app.config['RENDER_CACHE_BACKGROUND'] = True
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        tstore.db.session.add(world)
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+    process_render_cache_updates = tourist.process_render_cache_updates
+    process_calls = []
+
+    def locked_once(session):
+        process_calls.append(session)
+        if len(process_calls) == 1:
+            raise sqlalchemy.exc.OperationalError('DELETE', {}, Exception('database is locked'))
+        return process_render_cache_updates(session)
+
+    sleep_calls = []
+
+    def sleep(seconds):
+        sleep_calls.append(seconds)
+        if len(sleep_calls) == 2:
+            raise _StopWorker()
+
+    monkeypatch.setattr(tourist, 'process_render_cache_updates', locked_once)
+    monkeypatch.setattr(batchtool.time, 'sleep', sleep)
+    result = test_app.test_cli_runner().invoke(
+        batchtool.batchtool_cli, ['render-cache', '--worker', '--poll-seconds', '0'])
+    assert isinstance(result.exception, _StopWorker)
+
+    with test_app.app_context():
+        assert tstore.RenderCacheDirty.query.count() == 0
+        assert render_factory.get_place('world').name == 'World'
+
+
+def test_render_cache_rejects_options_it_would_ignore(test_app):
+    runner = test_app.test_cli_runner()
+    result = runner.invoke(batchtool.batchtool_cli,
+                           ['render-cache', '--worker', '--processes', '2'])
+    assert result.exit_code == 2
+    assert '--processes' in result.output
+    result = runner.invoke(batchtool.batchtool_cli, ['render-cache', '--worker', '--profile'])
+    assert result.exit_code == 2
+
+def test_structured_cache(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        tstore.db.session.add_all([world, country])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+        generation = render_factory.get_generation()
+
+    with test_app.app_context():
+        # The same object is returned until the generation changes.
+        place = render_factory.get_place('cc')
+        assert render_factory.get_place('cc') is place
+
+        country = tstore.Place.query.filter_by(short_name='cc').one()
+        country.name = 'Country Renamed'
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+        assert render_factory.get_generation() == generation + 1
+        assert render_factory.get_place('cc').name == 'Country Renamed'
+
+
+def test_generation_key_changes_on_out_of_order_activation(test_app):
+    with test_app.app_context():
+        store = render_store.get_store()
+        first, second = tstore.RenderCacheGeneration(), tstore.RenderCacheGeneration()
+        tstore.db.session.add_all([first, second])
+        tstore.db.session.commit()
+
+        second.activated_timestamp = datetime.datetime(2022, 1, 1)
+        tstore.db.session.commit()
+        key = store.get_generation_key()
+        first.activated_timestamp = datetime.datetime(2022, 1, 2)
+        tstore.db.session.commit()
+        assert store.get_generation_key() != key
+
+def test_generation_swap(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        tstore.db.session.add_all([world, country])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+        # Rows of a generation that hasn't been activated are not read.
+        pending = tstore.RenderCacheGeneration()
+        tstore.db.session.add(pending)
+        tstore.db.session.commit()
+        tstore.db.session.add(tstore.RenderCache(name=render_factory.place_cache_name('cc'),
+                                                 generation=pending.generation, deleted=True))
+        tstore.db.session.commit()
+        assert render_factory.get_place('cc').name == 'Country Name'
+
+        country.name = 'Country Renamed'
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+        assert render_factory.get_generation() == pending.generation + 1
+        assert render_factory.get_place('cc').name == 'Country Renamed'
+        # Rows hidden by the new generation were removed by the write, without collect_garbage.
+        assert tstore.RenderCache.query.filter_by(
+            name=render_factory.place_cache_name('cc')).count() == 1
+
+
+def test_sqlite_file_render_store(test_app, tmp_path):
+    test_app.config['RENDER_CACHE_SQLITE_PATH'] = str(tmp_path / 'render_cache.db')
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        tstore.db.session.add_all([world, country])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+        assert isinstance(render_store.get_store(), render_store.SqliteFileRenderStore)
+        assert render_factory.get_place('cc').name == 'Country Name'
+        assert tstore.RenderCache.query.count() == 0
+
+        # A process that only reads doesn't open the file for writing.
+        reader = render_store.SqliteFileRenderStore(test_app.config['RENDER_CACHE_SQLITE_PATH'])
+        assert reader.get_generation() == render_factory.get_generation()
+        assert reader._write_engine is None
+
+
+def test_build_profile(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        tstore.db.session.add_all([world, country])
+        tstore.db.session.commit()
+
+        profile = render_factory.BuildProfile()
+        tourist.rebuild_render_cache(tstore.db.session, None, profile)
+        assert profile.stages['load entities'].count == 2
+        assert profile.stages['place pages'].count == 2
+        assert profile.stages['write'].count == profile.stages['hash and compress'].count
+        assert 'place names' in profile.format_table()
+
+
+def test_snapshot_populates_relationships(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        pool = tstore.Pool(name='Pool', short_name='pool', parent=country, markdown='',
+                           entrance=point1)
+        club = tstore.Club(name='Our Club', short_name='our_club', parent=country,
+                           markdown='plays at [[pool]]')
+        comment = tstore.PlaceComment(source='test', content='Hi', place=country)
+        tstore.db.session.add_all([world, country, pool, club, comment])
+        tstore.db.session.commit()
+
+    with test_app.app_context():
+        snapshot = render_factory.load_snapshot()
+        statements = []
+        sqlalchemy.event.listen(tstore.db.engine, 'before_cursor_execute',
+                                lambda conn, cursor, statement, *args: statements.append(statement))
+        country = snapshot.get_place('cc')
+        assert [p.short_name for p in snapshot.get_place('world').child_places] == ['cc']
+        assert country.parent.short_name == 'world'
+        assert [c.short_name for c in country.child_clubs] == ['our_club']
+        assert [c.content for c in country.comments] == ['Hi']
+        assert [c.short_name for c in country.child_pools[0].club_back_links] == ['our_club']
+        assert statements == []
+
+
+def test_geometry_memo(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        pool = tstore.Pool(name='Pool', short_name='pool', parent=world, markdown='',
+                           entrance=point1)
+        tstore.db.session.add_all([world, pool])
+        tstore.db.session.commit()
+
+    with test_app.app_context():
+        world = tstore.Place.query.filter_by(short_name='world').one()
+        pool = tstore.Pool.query.filter_by(short_name='pool').one()
+        geometry = render_factory.GeometryMemo()
+        assert geometry.get(world.region) is geometry.get(world.region)
+        assert geometry.area(world) == world.area
+        assert geometry.center_geojson_feature(world) == world.center_geojson_feature
+        assert geometry.entrance_geojson_feature(pool) == pool.entrance_geojson_feature
+        assert geometry.maps_point_query(pool) == pool.maps_point_query
+
+
+def test_club_back_link_index(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        other = tstore.Place(name='Other', short_name='other', parent=world, region=polygon1,
+                             markdown='')
+        pool = tstore.Pool(name='Pool', short_name='pool', parent=country, markdown='')
+        unused_pool = tstore.Pool(name='Unused Pool', short_name='pool2', parent=country,
+                                  markdown='')
+        club_a = tstore.Club(name='Club A', short_name='club_a', parent=country,
+                             markdown='plays at [[pool]] and [[pool]]')
+        club_b = tstore.Club(name='Club B', short_name='club_b', parent=country,
+                             markdown='[[pool]] on Sunday')
+        # Links from clubs in another place are not back links.
+        club_other = tstore.Club(name='Club Other', short_name='club_other', parent=other,
+                                 markdown='[[pool]]')
+        tstore.db.session.add_all([world, country, other, pool, unused_pool, club_a, club_b,
+                                   club_other])
+        tstore.db.session.commit()
+
+    with test_app.app_context():
+        snapshot = render_factory.load_snapshot()
+        back_links = tstore.ClubBackLinkIndex.build(snapshot.places)
+        for p in snapshot.pools:
+            assert back_links.club_back_links(p) == p.club_back_links
+        pool = next(p for p in snapshot.pools if p.short_name == 'pool')
+        assert [c.short_name for c in back_links.club_back_links(pool)] == ['club_a', 'club_b']
+
+
+def test_geojson_features_shared_with_ancestors(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        metro = tstore.Place(name='Metro', short_name='metro', parent=country, region=polygon1,
+                             markdown='')
+        metro_no_pool = tstore.Place(name='Metro No Pool', short_name='metro_no_pool',
+                                     parent=country, region=polygon1, markdown='')
+        pool = tstore.Pool(name='Pool', short_name='pool', parent=metro, markdown='',
+                           entrance=point1)
+        club = tstore.Club(name='Our Club', short_name='our_club', parent=metro,
+                           markdown='plays at [[pool]]')
+        tstore.db.session.add_all([world, country, metro, metro_no_pool, pool, club])
+        tstore.db.session.commit()
+
+    with test_app.app_context():
+        snapshot = render_factory.load_snapshot()
+        features = render_factory.GeojsonFeatures(
+            render_factory.GeometryMemo(), tstore.ClubBackLinkIndex.build(snapshot.places))
+        for place in snapshot.places:
+            assert (features.children_geojson_features(place) ==
+                    place.children_geojson_features)
+        world_features = features.children_geojson_features(snapshot.get_place('world'))
+        metro_features = features.children_geojson_features(snapshot.get_place('metro'))
+        assert [f['properties']['title'] for f in world_features] == ['Pool', 'Metro No Pool']
+        assert world_features[0] is metro_features[0]
+
+
+def test_version_tables_incremental(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        tstore.db.session.add(world)
+        tstore.db.session.commit()
+        version_tables = continuumutils.get_version_tables()
+        first_transaction_id = version_tables.max_transaction_id
+
+        world.name = 'Earth'
+        tstore.db.session.commit()
+        # The same instance is returned with only the new transaction added.
+        assert continuumutils.get_version_tables() is version_tables
+        assert version_tables.max_transaction_id > first_transaction_id
+        assert version_tables.transaction_count == 2
+        history = version_tables.get_object_history(world)
+        assert len(history) == 2
+        assert version_tables.get_version_table(world).changeset(history[1], history[0]) == {
+            'name': ['World', 'Earth']}
+
+
+def test_parallel_build(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        metro = tstore.Place(name='Metro', short_name='metro', parent=country, region=polygon1,
+                             markdown='')
+        pool = tstore.Pool(name='Pool', short_name='pool', parent=metro, markdown='',
+                           entrance=point1)
+        club = tstore.Club(name='Our Club', short_name='our_club', parent=metro,
+                           markdown='plays at [[pool]]')
+        tstore.db.session.add_all([world, country, metro, pool, club])
+        tstore.db.session.commit()
+
+    with test_app.app_context():
+        serial_rows = list(render_factory.yield_cache())
+    with test_app.app_context():
+        profile = render_factory.BuildProfile()
+        parallel_rows = list(render_factory.yield_cache(profile=profile, processes=2))
+        assert profile.stages['place pages'].count == 3
+    assert ([(r.name, r.content_hash) for r in parallel_rows] ==
+            [(r.name, r.content_hash) for r in serial_rows])
+
+
+def test_unchanged_rows_not_written(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        metro_a = tstore.Place(name='Metro A', short_name='metro_a', parent=country,
+                               region=polygon1, markdown='')
+        metro_b = tstore.Place(name='Metro B', short_name='metro_b', parent=country,
+                               region=polygon1, markdown='')
+        club = tstore.Club(name='Club A', short_name='cluba', parent=metro_a, markdown='')
+        tstore.db.session.add_all([world, country, metro_a, metro_b, club])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+        generation = render_factory.get_generation()
+
+        # A complete rebuild without any change doesn't make a generation.
+        result = tourist.rebuild_render_cache(tstore.db.session, None)
+        assert result.written_count == 0
+        assert result.generation == generation
+        assert render_factory.get_generation() == generation
+
+        # The markdown of a club is only on the page of its place and in the CSV export.
+        club.markdown = 'Plays on Sunday'
+        tstore.db.session.commit()
+        result = tourist.rebuild_render_cache(tstore.db.session, None)
+        assert result.written_count == 2
+        assert result.skipped_count > 0
+        assert result.generation == generation + 1
+        assert render_factory.get_place('metro_a').child_clubs[0].markdown == 'Plays on Sunday'
+        assert render_factory.get_place('metro_b').name == 'Metro B'
+
+
+def test_recently_updated(test_app):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='')
+        old_club = tstore.Club(name='Old Club', short_name='old_club', parent=country,
+                               markdown='', status_date='2019-05-01')
+        new_club = tstore.Club(name='New Club', short_name='new_club', parent=country,
+                               markdown='', status_date='2021-02-03')
+        undated_club = tstore.Club(name='Undated Club', short_name='undated_club', parent=country,
+                                   markdown='', status_date='20200101')
+        tstore.db.session.add_all([world, country, old_club, new_club, undated_club])
+        tstore.db.session.commit()
+        tstore.db.session.add(tstore.Source(name='Source Name', source_short_name='src',
+                                            place_id=country.id,
+                                            sync_timestamp=datetime.datetime(2020, 6, 1)))
+        tstore.db.session.commit()
+        assert new_club.status_date_parsed == datetime.date(2021, 2, 3)
+        assert undated_club.status_date_parsed is None
+
+    with test_app.app_context():
+        statements = []
+        sqlalchemy.event.listen(tstore.db.engine, 'before_cursor_execute',
+                                lambda conn, cursor, statement, *args: statements.append(statement))
+        recently_updated = render_factory.build_recently_updated()
+        assert [(ru.club_name, ru.source_name) for ru in recently_updated] == [
+            ('New Club', None), (None, 'Source Name'), ('Old Club', None)]
+        assert recently_updated[1].path == '/tourist/place/cc'
+        assert recently_updated[0].place_name == 'Country Name'
+        assert len(statements) == 2
+
+
+def test_markdown_html(test_app, monkeypatch):
+    with test_app.app_context():
+        world = tstore.Place(name='World', short_name='world', region=polygon1, markdown='')
+        country = tstore.Place(name='Country Name', short_name='cc', parent=world, region=polygon1,
+                               markdown='*Big* country')
+        metro = tstore.Place(name='Metro', short_name='metro', parent=country, region=polygon1,
+                             markdown='')
+        pool = tstore.Pool(name='Pool Name', short_name='pool', parent=country, markdown='',
+                           entrance=point1)
+        club = tstore.Club(name='Our Club', short_name='our_club', parent=metro,
+                           markdown='Plays at [[pool]]<script>alert(1)</script>')
+        metro_b = tstore.Place(name='Metro B', short_name='metro_b', parent=country,
+                               region=polygon1, markdown='')
+        comment = tstore.PlaceComment(place=metro_b, source='test', content_markdown='Try [[pool]]',
+                                      timestamp=datetime.datetime(2023, 1, 1))
+        tstore.db.session.add_all([world, country, metro, pool, club, metro_b, comment])
+        tstore.db.session.commit()
+        tourist.update_render_cache(tstore.db.session)
+
+    with test_app.app_context():
+        assert render_factory.get_place('cc').markdown_html == '<p><em>Big</em> country</p>'
+        assert render_factory.get_place('metro').child_clubs[0].markdown_html == (
+            '<p>Plays at <a href="#pool">Pool Name</a></p>')
+
+        # Pages with club or comment markdown that links to a pool are rebuilt when it is renamed.
+        pool = tstore.Pool.query.filter_by(short_name='pool').one()
+        pool.name = 'Pool Renamed'
+        tstore.db.session.commit()
+        assert {'/place/metro', '/place/metro_b'} <= render_factory.get_affected_names(
+            {render_factory.entity_key(pool)})
+        tourist.update_render_cache(tstore.db.session)
+        assert 'Pool Renamed' in render_factory.get_place('metro').child_clubs[0].markdown_html
+        assert 'Pool Renamed' in render_factory.get_place('metro_b').comments[0].content_html
+
+    def fail_convert(*args, **kwargs):
+        raise AssertionError('markdown converted while serving a page')
+
+    monkeypatch.setattr('markdown.Markdown.convert', fail_convert)
+    with test_app.test_client() as c:
+        response = c.get('/tourist/place/metro')
+        assert response.status_code == 200
+        assert '<a href="#pool">Pool Renamed</a>' in response.get_data(as_text=True)
+        assert 'alert(1)' not in response.get_data(as_text=True)
@@ -2,13 +2,16 @@
 WikiLinks Extension for tourist-with-flask
 ==========================================
 
-Converts [[WikiLinks]] to links with text fetched from sqlalchemy.
+Converts [[WikiLinks]] to links with text fetched from sqlalchemy, or from the `get_pool_name`
+config option when it is set.
 
 Written by Tom Brown, based heavily on WikiLinks Extension that is Copyright The Python Markdown
 Project and used original code Copyright [Waylan Limberg](http://achinghead.com/).
 
 License: [BSD](http://www.opensource.org/licenses/bsd-license.php)
 '''
+from typing import Optional
+
 from markdown import Extension
 from markdown.inlinepatterns import InlineProcessor
 
@@ -16,8 +19,17 @@ from tourist.models import tstore
 import xml.etree.ElementTree as etree
 
 
+def _query_pool_name(short_name: str) -> Optional[str]:
+    pool = tstore.Pool.query.filter_by(short_name=short_name).one_or_none()
+    return pool.name if pool else None
+
+
 class WikiLinkExtension(Extension):
     def __init__(self, **kwargs):
+        self.config = {
+            'get_pool_name': [_query_pool_name,
+                              'Returns the name of the pool with a short_name or None'],
+        }
         super(WikiLinkExtension, self).__init__(**kwargs)
 
     def extendMarkdown(self, md):
@@ -38,10 +50,10 @@ class WikiLinksInlineProcessor(InlineProcessor):
     def handleMatch(self, m, data):
         label = m.group(1).strip()
         if label:
-            pool = tstore.Pool.query.filter_by(short_name=label).one_or_none()
-            if pool:
+            pool_name = self.config['get_pool_name'](label)
+            if pool_name:
                 a = etree.Element('a')
-                a.text = pool.name
+                a.text = pool_name
                 # All links are internal to the HTML page generated for a single place, at least for
                 # now. scripts/batchtool.py looks for links that might go between pages.
                 a.set('href', f'#{label}')